@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import bikeshare
+
+# Dataset sizes the benchmarks can run at, by name.
+SIZES = {'10k': 10000, '1m': 1000000, '10m': 10000000}
+
+# Directory holding the generated datasets, one sub-directory per size.
+DATA_DIR = 'benchmark_data'
+
+# Default file the baseline results are saved to and compared with.
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# Filters exercised for every city, as (month_filter, day_filter).
+FILTERS = {'none': ('All', 'All'),
+           'month': ('March', 'All'),
+           'day': ('All', 'Monday'),
+           'both': ('March', 'Monday')}
+
+# Cities without the Gender and Birth Year columns.
+CITIES_WITHOUT_DEMOGRAPHICS = ['WASHINGTON']
+
+# Rows generated at a time, to keep memory flat for the large datasets.
+GENERATE_CHUNK_ROWS = 1000000
+
+# Concurrent clients, and requests sent by each, when load testing the query server.
+SERVER_CLIENTS = 10
+SERVER_REQUESTS = 200
+
+# Python statements timed by the startup benchmark, each in a fresh interpreter.
+STARTUP_IMPORTS = {'python': 'pass',
+                   'import': 'import bikeshare',
+                   'import_numpy_pandas': 'import numpy, pandas'}
+
+# Command line options of the query timed to its first result by the startup benchmark.
+STARTUP_QUERY = ['--city', 'chicago', '--month', 'march', '--format', 'json']
+
+def generate_city_file(file_path, rows, seed, demographics=True):
+    """
+    Write a synthetic city file shaped like the real bikeshare exports.
+
+    The same arguments always produce the same file. Trips start between
+    January and June 2017, more of them at rush hours; stations are drawn from
+    a skewed list of names (some with commas, so they are quoted); and a few
+    user types, genders and birth years are left empty, as in the real files.
+
+    Args:
+    file_path (str): The file to write.
+    rows (int): The number of trips.
+    seed (int): Seed of the random number generator.
+    demographics (bool): Whether to include the Gender and Birth Year columns.
+    """
+    rng = np.random.default_rng(seed)
+
+    station_names = np.array([f'{street} St & {avenue} Ave' for street in range(1, 31) for avenue in range(1, 21)]
+                             + [f'Broadway, W {street} St' for street in range(40, 60)])
+    station_weights = 1 / np.arange(1, len(station_names) + 1) ** 0.8
+    station_weights /= station_weights.sum()
+
+    hour_weights = np.array([1, 1, 1, 1, 1, 2, 4, 8, 10, 6, 5, 5, 6, 6, 6, 7, 9, 12, 10, 7, 5, 4, 3, 2], dtype=float)
+    hour_weights /= hour_weights.sum()
+
+    first_day = np.datetime64('2017-01-01T00:00:00')
+    columns = ['', 'Start Time', 'End Time', 'Trip Duration', 'Start Station', 'End Station', 'User Type']
+    if demographics:
+        columns += ['Gender', 'Birth Year']
+
+    with open(file_path, 'w', newline='') as data:
+        data.write(','.join(columns) + '\n')
+
+        for chunk_start in range(0, rows, GENERATE_CHUNK_ROWS):
+            count = min(GENERATE_CHUNK_ROWS, rows - chunk_start)
+
+            seconds = (rng.integers(0, 181, count) * 86400 + rng.choice(24, count, p=hour_weights) * 3600
+                       + rng.integers(0, 3600, count))
+            start_times = first_day + seconds.astype('timedelta64[s]')
+            durations = np.round(rng.lognormal(6.5, 0.8, count), 3)
+            if demographics:
+                # Chicago and New York record whole seconds.
+                durations = np.round(durations)
+
+            trips = pd.DataFrame({
+                '': rng.integers(0, 10000000, count),
+                'Start Time': pd.Series(start_times).dt.strftime(bikeshare.TIME_FORMAT),
+                'End Time': pd.Series(start_times + durations.astype('int64').astype('timedelta64[s]')
+                                      ).dt.strftime(bikeshare.TIME_FORMAT),
+                'Trip Duration': durations if not demographics else durations.astype('int64'),
+                'Start Station': station_names[rng.choice(len(station_names), count, p=station_weights)],
+                'End Station': station_names[rng.choice(len(station_names), count, p=station_weights)],
+                'User Type': rng.choice(['Subscriber', 'Customer', 'Dependent', ''], count,
+                                        p=[0.78, 0.2, 0.001, 0.019]),
+            })
+            if demographics:
+                trips['Gender'] = rng.choice(['Male', 'Female', ''], count, p=[0.6, 0.2, 0.2])
+                birth_years = rng.integers(1930, 2002, count).astype(float)
+                birth_years[trips['Gender'].to_numpy() == ''] = np.nan
+                trips['Birth Year'] = birth_years
+
+            trips.to_csv(data, header=False, index=False, lineterminator='\n')
+
+def generate_dataset(size):
+    """
+    Generate the files of every city at one of the benchmark sizes, unless they already exist.
+
+    Args:
+    size (str): One of the names in SIZES.
+
+    Returns:
+    str: The directory holding the files.
+    """
+    directory = os.path.join(DATA_DIR, size)
+    os.makedirs(directory, exist_ok=True)
+
+    for seed, (city, file_name) in enumerate(sorted(bikeshare.CITY_DATA.items())):
+        file_path = os.path.join(directory, file_name)
+        if not os.path.exists(file_path):
+            print(f'Generating {file_path} ({SIZES[size]:,} rows)...')
+            generate_city_file(file_path, SIZES[size], seed, city not in CITIES_WITHOUT_DEMOGRAPHICS)
+
+    return directory
+
+def time_call(function, repeat):
+    """
+    Time a function, discarding anything it prints.
+
+    Args:
+    function (callable): The function to time, called without arguments.
+    repeat (int): The number of times to call it.
+
+    Returns:
+    float: The median wall time of one call, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start_time)
+
+    return statistics.median(timings)
+
+def run_benchmarks(sizes, repeat):
+    """
+    Benchmark load_data, calculations and disp_raw_data for every city, filter and size.
+
+    load_data is timed cold (with the city's caches removed first, so the CSV
+    file is parsed), warm (read from the caches) and cached (answered from the
+    in-memory result cache). Everything else runs with the result cache off,
+    so the work itself is timed.
+
+    Args:
+    sizes (list): Names of the dataset sizes to run at.
+    repeat (int): The number of timed calls of each warm benchmark.
+
+    Returns:
+    dict: The median time in seconds of each benchmark, keyed by 'size/city/filter/benchmark'.
+    """
+    results = {}
+    start_directory = os.getcwd()
+
+    for size in sizes:
+        os.chdir(generate_dataset(size))
+        try:
+            for city in bikeshare.CITY_DATA:
+                # Cold start: parse the CSV file and build the caches once.
+                shutil.rmtree(bikeshare.CACHE_DIR, ignore_errors=True)
+                results[f'{size}/{city}/none/load_data_cold'] = time_call(
+                    lambda: bikeshare.load_data(city, 'All', 'All'), 1)
+
+                for filter_name, (month_filter, day_filter) in FILTERS.items():
+                    key = f'{size}/{city}/{filter_name}'
+                    filtered_data = bikeshare.load_data(city, month_filter, day_filter)
+
+                    results[key + '/load_data_cached'] = time_call(
+                        lambda: bikeshare.load_data(city, month_filter, day_filter), repeat)
+                    bikeshare.result_cache.configure(0, 0)
+                    results[key + '/load_data'] = time_call(
+                        lambda: bikeshare.load_data(city, month_filter, day_filter), repeat)
+                    results[key + '/calculations'] = time_call(
+                        lambda: bikeshare.calculations(filtered_data), repeat)
+                    results[key + '/disp_raw_data'] = time_call(
+                        lambda: bikeshare.disp_raw_data(city, filtered_data, 0), repeat)
+
+                    bikeshare.result_cache.configure(bikeshare.RESULT_CACHE_ENTRIES, bikeshare.RESULT_CACHE_MB)
+
+                    print(f"{key:<28} load {results[key + '/load_data']:.4f}s  "
+                          f"cached {results[key + '/load_data_cached']:.4f}s  "
+                          f"calculations {results[key + '/calculations']:.4f}s  "
+                          f"raw data {results[key + '/disp_raw_data']:.4f}s")
+        finally:
+            os.chdir(start_directory)
+
+    return results
+
+async def load_test_server(clients, requests):
+    """
+    Time queries to a query server run in this process by many concurrent clients.
+
+    Each client keeps one connection open and sends random month/day filter
+    queries for random cities, one after the other.
+
+    Args:
+    clients (int): The number of concurrent clients.
+    requests (int): The number of requests sent by each client.
+
+    Returns:
+    list: The latency of every request, in seconds.
+    """
+    server = await asyncio.start_server(bikeshare.QueryServer().handle_client, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    rng = np.random.default_rng(0)
+    latencies = []
+
+    async def client(queries):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for city, month_filter, day_filter in queries:
+            start_time = time.perf_counter()
+            writer.write(f'GET /stats?city={city}&month={month_filter}&day={day_filter} HTTP/1.1\r\n'
+                         f'Host: localhost\r\n\r\n'.encode())
+            await writer.drain()
+
+            length = 0
+            while (header := await reader.readline()) != b'\r\n':
+                if header.lower().startswith(b'content-length:'):
+                    length = int(header.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start_time)
+        writer.close()
+
+    cities = [city.replace(' ', '_') for city in bikeshare.CITY_DATA]
+    months = ['All'] + bikeshare.FILTER_MONTHS
+    days = ['All'] + bikeshare.DAY_NAMES
+    workload = [[(rng.choice(cities), rng.choice(months), rng.choice(days)) for _ in range(requests)]
+                for _ in range(clients)]
+
+    async with server:
+        await asyncio.gather(*(client(queries) for queries in workload))
+
+    return latencies
+
+def run_server_benchmarks(sizes, clients, requests):
+    """
+    Load test the query server at every size.
+
+    Args:
+    sizes (list): Names of the dataset sizes to run at.
+    clients (int): The number of concurrent clients.
+    requests (int): The number of requests sent by each client.
+
+    Returns:
+    dict: The median and 99th percentile latency in seconds, keyed by 'size/server/p50' and 'size/server/p99'.
+    """
+    results = {}
+    start_directory = os.getcwd()
+
+    for size in sizes:
+        os.chdir(generate_dataset(size))
+        try:
+            latencies = np.array(asyncio.run(load_test_server(clients, requests)))
+        finally:
+            os.chdir(start_directory)
+
+        results[f'{size}/server/p50'] = float(np.percentile(latencies, 50))
+        results[f'{size}/server/p99'] = float(np.percentile(latencies, 99))
+        print(f"{size}/server: {len(latencies)} requests from {clients} clients, "
+              f"p50 {results[f'{size}/server/p50'] * 1000:.2f} ms, p99 {results[f'{size}/server/p99'] * 1000:.2f} ms")
+
+    return results
+
+def time_process(command, repeat, directory=None):
+    """
+    Time a command run in a new process, discarding its output.
+
+    Args:
+    command (list): The command and its arguments.
+    repeat (int): The number of times to run it.
+    directory (str): The directory to run it in, or None for the current one.
+
+    Returns:
+    float: The median wall time of one run, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run(command, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start_time)
+
+    return statistics.median(timings)
+
+def run_startup_benchmarks(sizes, repeat):
+    """
+    Time how long the program takes to start, and to print its first result, from a fresh interpreter.
+
+    The imports are timed from the directory of bikeshare.py, against a bare
+    interpreter and against importing numpy and pandas up front. The first
+    result is that of a --city query answered from the city's cached cube.
+
+    Args:
+    sizes (list): Names of the dataset sizes to run the query at.
+    repeat (int): The number of timed runs of each benchmark.
+
+    Returns:
+    dict: The median time in seconds of each benchmark, keyed by 'startup/statement'
+    and 'size/startup/first_result'.
+    """
+    results = {}
+    script = os.path.abspath(bikeshare.__file__)
+
+    for name, statement in STARTUP_IMPORTS.items():
+        results[f'startup/{name}'] = time_process([sys.executable, '-c', statement], repeat,
+                                                  os.path.dirname(script))
+        print(f"startup/{name:<20} {results[f'startup/{name}']:.4f}s")
+
+    for size in sizes:
+        directory = generate_dataset(size)
+        command = [sys.executable, script] + STARTUP_QUERY
+
+        # Build the cube once, so only the start-up and the query itself are timed.
+        subprocess.run(command, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+        results[f'{size}/startup/first_result'] = time_process(command, repeat, directory)
+        print(f"{size}/startup/first_result   {results[f'{size}/startup/first_result']:.4f}s")
+
+    return results
+
+def environment():
+    """
+    Describe the machine and library versions the benchmarks ran with.
+
+    Returns:
+    dict: The Python, NumPy and pandas versions and the platform.
+    """
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+def load_baselines(path):
+    """
+    Read the saved baselines of every command.
+
+    Args:
+    path (str): The baseline file.
+
+    Returns:
+    dict: The environment and results of each command's baseline, keyed by
+    command ('run', 'server' or 'startup'); empty if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as baseline_file:
+        baselines = json.load(baseline_file)
+
+    # Files saved before baselines were kept per command only held the 'run' results.
+    if 'results' in baselines:
+        baselines = {'run': baselines}
+
+    return baselines
+
+def compare_results(results, baseline, threshold):
+    """
+    Compare benchmark results with a baseline and list the regressions.
+
+    Args:
+    results (dict): The new results, from run_benchmarks.
+    baseline (dict): The baseline results, in the same form.
+    threshold (float): The allowed slowdown, e.g. 0.1 for 10%.
+
+    Returns:
+    tuple: The (benchmark, baseline seconds, new seconds) of every benchmark
+    slower than the baseline by more than the threshold, and the list of
+    benchmarks the baseline has no result for.
+    """
+    regressions = []
+    missing = []
+
+    print(f"{'Benchmark':<48}{'Baseline (s)':>14}{'Now (s)':>12}{'Change':>10}")
+    for key, seconds in results.items():
+        if key not in baseline:
+            print(f"{key:<48}{'-':>14}{seconds:>12.4f}{'-':>10}  NO BASELINE")
+            missing.append(key)
+            continue
+
+        change = seconds / baseline[key] - 1 if baseline[key] else 0.0
+        flag = '  REGRESSION' if change > threshold else ''
+        print(f'{key:<48}{baseline[key]:>14.4f}{seconds:>12.4f}{change:>+10.1%}{flag}')
+
+        if change > threshold:
+            regressions.append((key, baseline[key], seconds))
+
+    return regressions, missing
+
+def parse_arguments():
+    """
+    Parse the command line options.
+
+    Returns:
+    Namespace: The options.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the bikeshare analysis on synthetic data.')
+    parser.add_argument('command', choices=['generate', 'run', 'server', 'startup'],
+                        help='generate the datasets, run the benchmarks, load test the query server, '
+                             'or time the start-up')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['10k'],
+                        help='dataset sizes to use (default: 10k)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per benchmark (default: 5)')
+    parser.add_argument('--clients', type=int, default=SERVER_CLIENTS,
+                        help=f'concurrent clients of the server load test (default: {SERVER_CLIENTS})')
+    parser.add_argument('--requests', type=int, default=SERVER_REQUESTS,
+                        help=f'requests per client of the server load test (default: {SERVER_REQUESTS})')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results with the baseline')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help=f'baseline file (default: {BASELINE_FILE})')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown over the baseline reported as a regression (default: 0.1 = 10%%)')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+
+    if arguments.command == 'generate':
+        for size in arguments.sizes:
+            generate_dataset(size)
+        sys.exit(0)
+
+    if arguments.command == 'server':
+        results = run_server_benchmarks(arguments.sizes, arguments.clients, arguments.requests)
+    elif arguments.command == 'startup':
+        results = run_startup_benchmarks(arguments.sizes, arguments.repeat)
+    else:
+        results = run_benchmarks(arguments.sizes, arguments.repeat)
+
+    # Each command keeps its own baseline in the file, so saving one leaves the others alone.
+    baselines = load_baselines(arguments.baseline)
+    if arguments.save_baseline:
+        baselines[arguments.command] = {'environment': environment(), 'results': results}
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f'Baseline for {arguments.command} saved to {arguments.baseline}')
+
+    if arguments.compare:
+        if arguments.command not in baselines:
+            print(f'{arguments.baseline} has no baseline for {arguments.command}; save one with --save-baseline.')
+            sys.exit(1)
+
+        regressions, missing = compare_results(results, baselines[arguments.command]['results'],
+                                               arguments.threshold)
+        if len(missing) == len(results):
+            print(f'None of the benchmarks are in the {arguments.command} baseline; nothing was compared.')
+            sys.exit(1)
+        if missing:
+            print(f'Warning: {len(missing)} benchmark(s) have no baseline and were not compared.')
+        if regressions:
+            print(f'{len(regressions)} benchmark(s) regressed by more than {arguments.threshold:.0%}.')
+            sys.exit(1)
+        print('No regressions.')
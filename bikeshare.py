@@ -1,305 +1,3324 @@
-import time
-import pandas as pd
-import numpy as np
+import argparse
 import csv
-from collections import Counter
-from datetime import datetime
+import importlib
+import io
+import json
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from datetime import date
+from urllib.parse import parse_qsl, urlsplit
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then reported as 0.
+    resource = None
+
+class LazyModule:
+    """
+    Stand in for a module until one of its attributes is first used, then import it.
+
+    pandas and numpy make up most of the program's startup time, yet a query
+    answered from the cube never needs pandas, and bad arguments or the
+    first prompt need neither. On first use the real module replaces the
+    stand-in in this module's globals, so later uses cost nothing extra.
+    """
+
+    def __init__(self, name, alias):
+        """
+        Create the stand-in.
+
+        Args:
+        name (str): The module to import, e.g. 'numpy'.
+        alias (str): The global name the module is used under here, e.g. 'np'.
+        """
+        self.name = name
+        self.alias = alias
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.name)
+        globals()[self.alias] = module
+        return getattr(module, attribute)
+
+# Heavy modules, imported only when first used.
+pd = LazyModule('pandas', 'pd')
+np = LazyModule('numpy', 'np')
+asyncio = LazyModule('asyncio', 'asyncio')
+futures = LazyModule('concurrent.futures', 'futures')
+
+# Map each city to its data file.
+CITY_DATA = {'CHICAGO': 'chicago.csv',
+             'NEW YORK': 'new_york_city.csv',
+             'WASHINGTON': 'washington.csv'}
+
+# Format of the 'Start Time' and 'End Time' columns.
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Month names (month 1 first) and day names (Monday first, as numbered by pandas).
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June',
+               'July', 'August', 'September', 'October', 'November', 'December']
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Months offered by the month filter.
+FILTER_MONTHS = MONTH_NAMES[:6]
+
+# Fields of the records written by flatten_statistics, in report order.
+REPORT_FIELDS = ['city', 'month_filter', 'day_filter', 'trip_count',
+                 'popular_month', 'popular_month_count', 'popular_day', 'popular_day_count',
+                 'popular_hour', 'popular_hour_count', 'total_duration', 'average_duration',
+                 'popular_start_station', 'popular_start_station_count',
+                 'popular_end_station', 'popular_end_station_count',
+                 'popular_route_start', 'popular_route_end', 'popular_route_count',
+                 'subscribers', 'customers', 'dependents', 'male', 'female',
+                 'earliest_birth_year', 'latest_birth_year', 'popular_birth_year', 'popular_birth_year_count']
+
+# Columns derived from 'Start Time' by read_city_table.
+DERIVED_COLUMNS = ['month', 'day_of_week', 'hour']
+
+# Text columns, stored in the cache as integer codes plus a list of distinct values.
+STRING_COLUMNS = ['Start Station', 'End Station', 'User Type', 'Gender']
+
+# Station columns, which share one sorted dictionary of station names per city.
+STATION_COLUMNS = ['Start Station', 'End Station']
+
+# Directory (next to the city files) holding the binary table cache.
+CACHE_DIR = '.bikeshare_cache'
+
+# Bump whenever the layout of the cached tables changes.
+CACHE_VERSION = 5
+
+# Errors raised by a cache file that is damaged, e.g. cut short by a crash.
+CACHE_ERRORS = (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile, zlib.error)
+
+# Bytes read at a time when checksumming the ingested part of a city file, to
+# tell rows appended to a file from a rewritten file.
+INGEST_CHECK_BYTES = 1 << 24
+
+# Options for reading a city CSV file. Empty strings are kept as they are so
+# text columns match the raw file.
+CSV_OPTIONS = {'keep_default_na': False,
+               'dtype': {'Start Station': str, 'End Station': str, 'User Type': str,
+                         'Gender': str, 'Birth Year': str}}
+
+# Number of processes parsing a city file when its cached table or cube must
+# be built (0 for one per CPU); set with --parse-workers.
+PARSE_WORKERS = 1
+
+# Number of rows parsed at a time when a city file is streamed in chunks.
+CHUNK_SIZE = 500000
+
+# Number of bytes scanned at a time when indexing the rows of a city file.
+INDEX_BLOCK_SIZE = 1 << 24
+
+# Number of bytes of a city file parsed at a time by read_city_table.
+SCAN_BLOCK_SIZE = 1 << 26
+
+# Number of rows whose fields field_bytes gathers at a time.
+FIELD_ROWS = 1 << 16
+
+# Columns of the city files holding numbers, and timestamps.
+NUMBER_COLUMNS = ['Trip Duration', 'Birth Year']
+TIME_COLUMNS = ['Start Time', 'End Time']
+
+# Levels of detail of the stage profiler, from least to most.
+PROFILE_LEVELS = ['off', 'summary', 'detailed']
+
+# Address the query server listens on by default.
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8642
+
+# Reason phrases of the HTTP statuses the query server sends.
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                500: 'Internal Server Error'}
+
+# Default number of stations and routes listed by the top-K queries.
+TOP_K = 5
+
+# Counters kept by each Space-Saving summary of the approximate top-K queries.
+SKETCH_CAPACITY = 1000
+
+# Relative error and failure probability of the Count-Min sketch estimates.
+SKETCH_EPSILON = 0.001
+SKETCH_DELTA = 0.01
+
+# Trip duration quantiles reported by the time series analytics.
+DURATION_QUANTILES = [0.5, 0.9, 0.99]
+
+# Relative accuracy of the quantiles estimated by QuantileSketch.
+QUANTILE_ACCURACY = 0.01
+
+# Default limits of the in-memory result cache: number of results and megabytes held.
+RESULT_CACHE_ENTRIES = 128
+RESULT_CACHE_MB = 256
+
+class Profiler:
+    """
+    Records the cost of each stage of an analysis: wall and CPU time, rows
+    processed, rows per second and peak memory.
+
+    At the 'off' level nothing is recorded. At 'summary' each run of a stage is
+    timed and the runs of a stage are added up in the report. At 'detailed'
+    every run is also listed, and memory allocations are traced so the peak
+    memory allocated by each stage can be reported as well as the process'
+    peak RSS.
+
+    Stages may be nested, e.g. the 'load' of a city file inside a 'cube load'.
+    The time of a nested stage is counted in that stage only, so the times of
+    all the stages add up to the time profiled; the peak memory of a stage
+    includes the stages nested in it.
+    """
+
+    def __init__(self, level='off'):
+        """
+        Create a profiler.
+
+        Args:
+        level (str): One of PROFILE_LEVELS.
+        """
+        self.level = 'off'
+        self.records = []
+        self.set_level(level)
+
+        # The stages running in each thread, innermost last.
+        self.active = threading.local()
+
+    def set_level(self, level):
+        """
+        Change the level of detail, starting or stopping memory tracing as needed.
+
+        Args:
+        level (str): One of PROFILE_LEVELS.
+        """
+        if level not in PROFILE_LEVELS:
+            raise ValueError(f"Unknown profile level {level!r}, expected one of {PROFILE_LEVELS}")
+
+        if level == 'detailed' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif level != 'detailed' and self.level == 'detailed':
+            tracemalloc.stop()
+
+        self.level = level
+
+    def reset(self):
+        """
+        Forget the stages recorded so far.
+        """
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """
+        Measure the code run inside a 'with' block as one run of a stage.
+
+        The time spent in stages nested inside the block is left out of this
+        stage's time.
+
+        Args:
+        name (str): The name of the stage.
+        rows (int): The number of rows processed, if known up front.
+
+        Yields:
+        dict: The record of this run; set its 'rows' entry once the number of rows is known.
+        """
+        record = {'stage': name, 'rows': rows}
+        if self.level == 'off':
+            yield record
+            return
+
+        stages = self.active.__dict__.setdefault('stages', [])
+        run = {'nested_wall': 0.0, 'nested_cpu': 0.0, 'peak': 0}
+        if self.level == 'detailed':
+            # Keep the peak reached so far by the enclosing stages before starting this one's.
+            peak = tracemalloc.get_traced_memory()[1]
+            for outer in stages:
+                outer['peak'] = max(outer['peak'], peak)
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+
+        stages.append(run)
+        # perf_counter is monotonic and has the highest available resolution.
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            stages.pop()
+            if stages:
+                stages[-1]['nested_wall'] += wall_seconds
+                stages[-1]['nested_cpu'] += cpu_seconds
+
+            record['wall_seconds'] = wall_seconds - run['nested_wall']
+            record['cpu_seconds'] = cpu_seconds - run['nested_cpu']
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            if self.level == 'detailed':
+                peak = max(run['peak'], tracemalloc.get_traced_memory()[1])
+                record['peak_traced_bytes'] = peak - traced_before
+            self.records.append(record)
+
+    def summary(self):
+        """
+        Add up the runs of each stage.
+
+        Returns:
+        list: One dictionary per stage, in the order the stages first ran.
+        """
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record['stage'], {'stage': record['stage'], 'runs': 0, 'rows': 0,
+                                                        'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                        'peak_rss_bytes': 0})
+            total['runs'] += 1
+            total['rows'] += record['rows']
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'], record['peak_rss_bytes'])
+            if 'peak_traced_bytes' in record:
+                total['peak_traced_bytes'] = max(total.get('peak_traced_bytes', 0), record['peak_traced_bytes'])
+
+        for total in stages.values():
+            total['rows_per_second'] = total['rows'] / total['wall_seconds'] if total['wall_seconds'] else None
+
+        return list(stages.values())
+
+    def to_dict(self):
+        """
+        Collect the profile in a form that can be saved as JSON.
+
+        Returns:
+        dict: The level, the per-stage summary and, at the 'detailed' level, every run.
+        """
+        profile = {'level': self.level, 'stages': self.summary()}
+        if self.level == 'detailed':
+            profile['runs'] = self.records
+
+        return profile
+
+    def write_json(self, path):
+        """
+        Save the profile to a JSON file.
+
+        Args:
+        path (str): The file to write.
+        """
+        with open(path, 'w') as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+            profile_file.write('\n')
+
+    def report(self):
+        """
+        Display the per-stage summary as a table.
+        """
+        if self.level == 'off':
+            return
+
+        print(f"{'Stage':<14}{'Runs':>6}{'Rows':>12}{'Wall (s)':>11}{'CPU (s)':>10}{'Rows/s':>13}{'Peak MiB':>10}")
+        for total in self.summary():
+            rate = f"{total['rows_per_second']:,.0f}" if total['rows_per_second'] else '-'
+            peak = total.get('peak_traced_bytes', total['peak_rss_bytes']) / (1 << 20)
+            print(f"{total['stage']:<14}{total['runs']:>6}{total['rows']:>12,}{total['wall_seconds']:>11.4f}"
+                  f"{total['cpu_seconds']:>10.4f}{rate:>13}{peak:>10.1f}")
+        print()
+
+def peak_rss_bytes():
+    """
+    Return the peak resident memory of this process so far.
+
+    Returns:
+    int: The peak RSS in bytes, or 0 where it cannot be measured.
+    """
+    if resource is None:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# The profiler used by every stage; switched on with --profile.
+profiler = Profiler()
+
+class ResultCache:
+    """
+    Keeps the most recently used query results in memory: statistics and
+    filtered trips, keyed by city, filters and the city file's signature.
+
+    Because the signature is part of the key, results computed from an older
+    version of a city file are never returned; they simply stop being used and
+    are evicted in turn. The least recently used results are evicted whenever
+    the cache holds more than its maximum number of results or megabytes.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_ENTRIES, max_mb=RESULT_CACHE_MB):
+        """
+        Create an empty cache.
+
+        Args:
+        max_entries (int): The maximum number of results held (0 disables the cache).
+        max_mb (float): The maximum memory held by the results, in megabytes.
+        """
+        self.entries = OrderedDict()
+        # The query server also uses the cache from worker threads.
+        self.lock = threading.RLock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.configure(max_entries, max_mb)
+
+    def configure(self, max_entries, max_mb):
+        """
+        Change the limits of the cache, evicting results until it fits them.
+
+        Args:
+        max_entries (int): The maximum number of results held (0 disables the cache).
+        max_mb (float): The maximum memory held by the results, in megabytes.
+        """
+        with self.lock:
+            self.max_entries = max_entries
+            self.max_bytes = int(max_mb * (1 << 20))
+            self.evict()
+
+    def get(self, key):
+        """
+        Look up a result, marking it as the most recently used.
+
+        Args:
+        key (tuple): The key the result was stored under.
+
+        Returns:
+        object: The result, or None if it is not cached.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        """
+        Store a result, evicting the least recently used ones if the cache is full.
+
+        Results larger than the whole cache are not stored.
+
+        Args:
+        key (tuple): The key to store the result under.
+        value (object): The result: a DataFrame or a statistics dict.
+        """
+        size = result_size(value)
+        if size > self.max_bytes or self.max_entries == 0:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used results until the cache is within its limits.
+        """
+        with self.lock:
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, (_, size) = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every result and reset the counters.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def summary(self):
+        """
+        Describe the use of the cache.
+
+        Returns:
+        dict: The hits, misses, evictions, number of results held and megabytes held.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'mb': round(self.size / (1 << 20), 3)}
+
+def result_size(value):
+    """
+    Estimate the memory held by a cached result.
+
+    Args:
+    value (object): A DataFrame of trips, or a statistics or time series dict.
+
+    Returns:
+    int: The estimated size in bytes.
+    """
+    # Statistics are a handful of small values; their JSON text is a fair measure.
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + len(json.dumps(value, default=str))
+
+    return int(value.memory_usage(deep=True).sum())
+
+def result_key(city, month_filter, day_filter, kind):
+    """
+    Build the result cache key of a query.
+
+    Args:
+    city (str): The city queried.
+    month_filter (str): The month filter.
+    day_filter (str): The day filter.
+    kind (str): 'stats' for statistics, 'time series' for time_series, or 'trips' for the filtered trips.
+
+    Returns:
+    tuple: The key, which includes the current signature of the city file.
+    """
+    return (city, month_filter, day_filter, kind, tuple(file_signature(CITY_DATA[city]).tolist()))
+
+# The results shared by every query; limits are set with --cache-entries and --cache-mb.
+result_cache = ResultCache()
+
+def load_data(city, month_filter, day_filter):
+    """
+    Load and filter the data for a given city and apply month and day filters.
+
+    Args:
+    city (str): The city to analyze (options are 'CHICAGO', 'NEW YORK', 'WASHINGTON').
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+
+    Returns:
+    DataFrame: A columnar table of the trips matching the given filters. The
+    table may be shared with later calls through the result cache, so it must
+    not be modified.
+    """
+    return TripQuery(city).filter(month_filter, day_filter).collect()
+
+class TripQuery:
+    """
+    A lazy query over the trips of a city: filter by month and day, then keep
+    some of the columns.
+
+    Building a query reads nothing. When its trips are collected, the filters
+    and the column selection are pushed down into the reader: with a current
+    table cache only the month and day columns are read to find the matching
+    rows, and then only the selected columns, for those rows only. Columns a
+    city does not have (Gender and Birth Year in Washington) are left out, as
+    told by the city's schema. Aggregates never need the trips at all: they
+    are answered from the city's cube.
+    """
+
+    def __init__(self, city, month_filter='All', day_filter='All', columns=None):
+        """
+        Create a query.
+
+        Args:
+        city (str): The city to query.
+        month_filter (str): The month to filter by, or 'All' to apply no month filter.
+        day_filter (str): The day to filter by, or 'All' to apply no day filter.
+        columns (list): The columns to keep, or None for every column.
+        """
+        self.city = city
+        self.month_filter = month_filter
+        self.day_filter = day_filter
+        self.columns = columns
+
+    def filter(self, month_filter='All', day_filter='All'):
+        """
+        Restrict the query to a month and day of the week.
+
+        Args:
+        month_filter (str): The month to filter by, or 'All' to apply no month filter.
+        day_filter (str): The day to filter by, or 'All' to apply no day filter.
+
+        Returns:
+        TripQuery: A new query with the filters.
+        """
+        return TripQuery(self.city, month_filter, day_filter, self.columns)
+
+    def select(self, *columns):
+        """
+        Restrict the query to some columns. With no columns only the row numbers are read.
+
+        Args:
+        *columns (str): The columns to keep.
+
+        Returns:
+        TripQuery: A new query keeping only those columns.
+        """
+        return TripQuery(self.city, self.month_filter, self.day_filter, list(columns))
+
+    def schema(self):
+        """
+        List the columns the city's trips have.
+
+        Returns:
+        list: The column names, in the form returned by city_schema.
+        """
+        return city_schema(CITY_DATA[self.city])
+
+    def collect(self):
+        """
+        Read the trips matching the query.
+
+        Returns:
+        DataFrame: The selected columns of the matching trips, indexed by row
+        number in the file. The table may be shared with later calls through
+        the result cache, so it must not be modified.
+        """
+        file_path = CITY_DATA[self.city]
+        columns = [name for name in self.schema() if self.columns is None or name in self.columns]
+
+        kind = 'trips' if self.columns is None else 'trips:' + ','.join(columns)
+        key = result_key(self.city, self.month_filter, self.day_filter, kind)
+        filtered_data = result_cache.get(key)
+        if filtered_data is not None:
+            return filtered_data
+
+        cache_path = cache_file_path(file_path, 'table')
+        cache = open_cache_file(cache_path, file_signature(file_path))
+        if cache is not None:
+            try:
+                with cache:
+                    # Only the month and day columns are read to find the matching rows.
+                    rows = None
+                    if self.month_filter != 'All' or self.day_filter != 'All':
+                        with profiler.stage('filter') as stage:
+                            filter_columns = pd.DataFrame({name: cache[name] for name in ['month', 'day_of_week']})
+                            rows = filter_mask(filter_columns, self.month_filter, self.day_filter)
+                            stage['rows'] = len(rows)
+                    with profiler.stage('load') as stage:
+                        filtered_data = table_from_cache(cache, columns, rows)
+                        stage['rows'] = len(filtered_data)
+            except CACHE_ERRORS:
+                # A damaged cache; it is rebuilt below.
+                filtered_data = None
+
+        if filtered_data is None:
+            # Read the CSV file (or the rows appended to it), which refreshes the cache.
+            with profiler.stage('load') as stage:
+                table = load_city_table(file_path)
+                stage['rows'] = len(table)
+            with profiler.stage('filter', rows=len(table)):
+                filtered_data = table.loc[filter_mask(table, self.month_filter, self.day_filter), columns]
+
+        result_cache.put(key, filtered_data)
+        return filtered_data
+
+    def statistics(self):
+        """
+        Compute the statistics of the query's trips, from the city's cube.
+
+        Returns:
+        dict: The statistics, in the form returned by summarize_counts.
+        """
+        return filter_statistics(self.city, self.month_filter, self.day_filter)
+
+    def top(self, k=TOP_K):
+        """
+        Find the most popular stations and routes of the query's trips, from the city's cube.
+
+        Args:
+        k (int): The number of stations and routes wanted.
+
+        Returns:
+        dict: The lists returned by cube_top_k.
+        """
+        return top_k(self.city, self.month_filter, self.day_filter, k)
+
+def city_schema(file_path):
+    """
+    List the columns of the typed table of a city file, from the file's header row.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+
+    Returns:
+    list: The columns read_city_table returns for the file, e.g. without
+    'Gender' and 'Birth Year' for Washington.
+    """
+    with open(file_path, newline='') as data:
+        header = next(csv.reader(data))
+
+    return [name for name in header if name and not name.startswith('Unnamed')] + DERIVED_COLUMNS
+
+def read_city_table(file_path):
+    """
+    Read a city CSV file into a typed columnar table.
+
+    'Start Time' is parsed once into datetime64 values, and the month, day of
+    the week and hour are derived from it as small integer columns.
+
+    The file is memory-mapped and parsed a block at a time by scan_block.
+    Blocks the scanner does not handle are parsed by pandas instead.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+
+    Returns:
+    DataFrame: One row per trip, indexed by the trip's row number in the file.
+    """
+    tables = list(read_city_blocks(file_path, SCAN_BLOCK_SIZE))
+    if not tables:
+        return prepare_table(pd.read_csv(file_path, **CSV_OPTIONS))
+
+    return encode_stations(concat_tables(tables))
+
+def read_city_blocks(file_path, block_size, columns=None, start=None, end=None):
+    """
+    Parse a city CSV file a block of bytes at a time, without copying the file into memory.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    block_size (int): The approximate number of bytes in each block; blocks end at the end of a row.
+    columns (list): The CSV columns to parse, or None for all of them. 'Start
+    Time' is always parsed, since the month, day and hour are derived from it.
+    start (int): Offset of the first byte to parse, at the start of a line, or None to start after the header.
+    end (int): Offset just past the last byte to parse, just after a line break, or None for the end of the file.
+
+    Yields:
+    DataFrame: The rows of each block (blocks holding no rows are skipped),
+    in the form returned by read_city_table but numbered from 0 in each block.
+    """
+    with open(file_path, 'rb') as data:
+        header = next(csv.reader([data.readline().decode()]))
+        start = data.tell() if start is None else start
+        end = os.fstat(data.fileno()).st_size if end is None else end
+        if end <= start:
+            return
+
+        mapped = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while start < end:
+                # Extend the block to the end of the row it stops in.
+                block_end = row_end(mapped, start, min(start + block_size, end) - 1, end)
+
+                # The block is a view of the mapped file, released before the next one is taken.
+                block = np.frombuffer(mapped, dtype='uint8', count=block_end - start, offset=start)
+                table = scan_block(block, header, columns)
+                if table is None:
+                    table = parse_block(block, header, columns)
+                del block
+
+                start = block_end
+                if table is not None:
+                    yield table
+        finally:
+            # A parsing error still references the block it was raised in, which
+            # keeps the map open until the error is released.
+            with suppress(BufferError):
+                mapped.close()
+
+def row_end(mapped, start, position, end):
+    """
+    Find the end of the row a byte of a city file is in.
+
+    A quoted value may hold line breaks, so a line break only ends a row when
+    an even number of quotes comes before it since the start of a row.
+
+    Args:
+    mapped (mmap): The memory-mapped city file.
+    start (int): Offset of the start of a row at or before the byte.
+    position (int): Offset of the byte.
+    end (int): Offset just past the last byte of the rows.
+
+    Returns:
+    int: The offset just after the line break ending the row, or end if no line break does.
+    """
+    quotes = 0
+    while True:
+        line_end = mapped.find(b'\n', position, end) + 1 or end
+        quotes += count_quotes(mapped, start, line_end)
+        if quotes % 2 == 0 or line_end == end:
+            return line_end
+        start = position = line_end
+
+def count_quotes(mapped, start, end):
+    """
+    Count the quote characters in a range of a memory-mapped file.
+
+    Args:
+    mapped (mmap): The memory-mapped file.
+    start (int): Offset of the first byte of the range.
+    end (int): Offset just past the last byte of the range.
+
+    Returns:
+    int: The number of '"' bytes in the range.
+    """
+    if end <= start:
+        return 0
+
+    # The view of the mapped file is released as soon as the count is made.
+    return int(np.count_nonzero(np.frombuffer(mapped, dtype='uint8', count=end - start, offset=start) == ord('"')))
+
+def scan_block(block, header, columns=None):
+    """
+    Parse a block of whole lines of a city file by locating its fields in the raw bytes.
+
+    Line breaks and the commas between fields are found with vectorized byte
+    comparisons (commas inside quoted fields are skipped). Then only the
+    wanted fields are gathered, straight into fixed-width byte arrays:
+    timestamps are decoded by decode_timestamp_chars, numbers are converted by
+    NumPy and text values are encoded as categoricals, so only their distinct
+    values are ever decoded into strings.
+
+    Args:
+    block (ndarray): The bytes of the lines, as uint8.
+    header (list): The column names from the file's header row.
+    columns (list): The CSV columns to parse, or None for all of them.
+
+    Returns:
+    DataFrame: The rows of the block, in the form returned by read_city_table
+    but numbered from 0, or None if the block holds no rows or has a layout
+    the scanner does not handle, e.g. a row with a missing field or a value
+    spanning lines.
+    """
+    # Lines, without their line breaks; blank lines are skipped, as pandas does.
+    line_breaks = np.flatnonzero(block == ord('\n'))
+    line_starts = np.concatenate([[0], line_breaks + 1])
+    line_ends = np.concatenate([line_breaks, [len(block)]])
+    line_ends -= (line_ends > line_starts) & (block[np.maximum(line_ends - 1, 0)] == ord('\r'))
+    is_row = line_ends > line_starts
+    line_starts, line_ends = line_starts[is_row], line_ends[is_row]
+    if len(line_starts) == 0:
+        return None
+
+    # Commas separate fields, except inside quotes. A line with an odd number
+    # of quotes has a value that spans lines.
+    commas = np.flatnonzero(block == ord(','))
+    quotes = np.flatnonzero(block == ord('"'))
+    if len(quotes):
+        quote_lines = np.searchsorted(line_starts, quotes, side='right') - 1
+        if (np.bincount(quote_lines, minlength=len(line_starts)) % 2).any():
+            return None
+        commas = commas[np.searchsorted(quotes, commas) % 2 == 0]
+
+    # Every row must have every field.
+    commas_per_row = np.diff(np.searchsorted(commas, np.append(line_starts, len(block))))
+    if (commas_per_row != len(header) - 1).any():
+        return None
+
+    commas = commas.reshape(len(line_starts), len(header) - 1)
+
+    table = {}
+    for position, name in enumerate(header):
+        if not name or name.startswith('Unnamed') or (columns is not None and name not in columns
+                                                      and name != 'Start Time'):
+            continue
+
+        starts = line_starts if position == 0 else commas[:, position - 1] + 1
+        ends = line_ends if position == len(header) - 1 else commas[:, position]
+        if name in TIME_COLUMNS:
+            # Timestamps are 19 bytes long; gather them as 20 with a zero at the end.
+            if (ends - starts != 19).any():
+                return None
+            chars = field_bytes(block, starts, ends, 20)
+            if not is_timestamp_layout(chars):
+                return None
+            times = decode_timestamp_chars(chars)
+            table[name] = times['time']
+            if name == 'Start Time':
+                derived = {column: times[column] for column in DERIVED_COLUMNS}
+        elif name in NUMBER_COLUMNS:
+            # Empty numbers are missing values.
+            width = max(int((ends - starts).max()), 3)
+            values = field_bytes(block, starts, ends, width).view(f'S{width}').ravel()
+            values = np.where(ends > starts, values, b'nan')
+            try:
+                table[name] = values.astype('float64')
+            except ValueError:
+                return None
+        else:
+            table[name] = text_categorical(*distinct_fields(block, starts, ends))
+
+    table.update(derived)
+    return pd.DataFrame(table)
+
+def field_bytes(block, starts, ends, width):
+    """
+    Gather one field of every row into a fixed-width array of bytes.
+
+    Args:
+    block (ndarray): The bytes of the lines, as uint8.
+    starts (ndarray): The offset of the field in each row.
+    ends (ndarray): The offset just past the field in each row.
+    width (int): The width of the array; longer fields are cut short.
+
+    Returns:
+    ndarray: A rows x width uint8 array, padded with zeros.
+    """
+    chars = np.empty((len(starts), width), dtype='uint8')
+    columns = np.arange(width)
+
+    # A slice of rows at a time, so the offsets of every byte gathered stay small.
+    for first in range(0, len(starts), FIELD_ROWS):
+        offsets = starts[first:first + FIELD_ROWS, None] + columns
+        part = block[np.minimum(offsets, len(block) - 1)]
+        part[offsets >= ends[first:first + FIELD_ROWS, None]] = 0
+        chars[first:first + FIELD_ROWS] = part
+
+    return chars
+
+def distinct_fields(block, starts, ends):
+    """
+    Find the distinct values of a text field, and which one each row holds, without decoding any text.
+
+    The bytes of each value are read as a few 64-bit words, and the rows are
+    grouped by hashing those words one after the other (pd.factorize), which
+    takes a single pass per word instead of a sort.
+
+    Args:
+    block (ndarray): The bytes of the lines, as uint8.
+    starts (ndarray): The offset of the field in each row.
+    ends (ndarray): The offset just past the field in each row.
+
+    Returns:
+    tuple: The distinct values as raw bytes, and the position of each row's value among them.
+    """
+    width = max(-(-int((ends - starts).max()) // 8) * 8, 8)
+    chars = field_bytes(block, starts, ends, width)
+    words = chars.view('uint64')
+
+    codes = np.zeros(len(chars), dtype='int64')
+    for column in range(words.shape[1]):
+        word_codes, word_values = pd.factorize(words[:, column])
+        codes, _ = pd.factorize(codes * len(word_values) + word_codes)
+    value_count = int(codes.max()) + 1 if len(codes) else 0
+
+    # The first row holding each value; writing in reverse leaves the first one.
+    first_rows = np.zeros(value_count, dtype='int64')
+    first_rows[codes[::-1]] = np.arange(len(codes))[::-1]
+    return chars[first_rows].view(f'S{width}').ravel(), codes
+
+def text_categorical(values, codes):
+    """
+    Build a categorical column from the distinct raw values of a text field and the code of each row.
+
+    Args:
+    values (ndarray): The distinct values as raw bytes, possibly quoted.
+    codes (ndarray): The position of each row's value in `values`.
+
+    Returns:
+    Categorical: The column, with its categories (the unquoted values) sorted.
+    """
+    names = np.array([unquote(value.decode()) for value in values.tolist()], dtype=str)
+
+    # Unquoting can change the order of the values and make two of them equal.
+    sorted_names, name_codes = np.unique(names, return_inverse=True)
+    return pd.Categorical.from_codes(name_codes[codes], sorted_names)
+
+def unquote(value):
+    """
+    Remove the CSV quoting of a field value.
+
+    Args:
+    value (str): The raw value.
+
+    Returns:
+    str: The value without its surrounding quotes and with doubled quotes made single.
+    """
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('""', '"')
+
+    return value
+
+def parse_block(block, header, columns=None):
+    """
+    Parse a block of whole lines of a city file with pandas, for the blocks scan_block does not handle.
+
+    Args:
+    block (ndarray): The bytes of the lines, as uint8.
+    header (list): The column names from the file's header row.
+    columns (list): The CSV columns to parse, or None for all of them.
+
+    Returns:
+    DataFrame: The rows of the block, in the form returned by read_city_table
+    but numbered from 0, or None if the block holds no rows.
+    """
+    usecols = None if columns is None else [name for name in header if name in columns or name == 'Start Time']
+    try:
+        table = pd.read_csv(io.BytesIO(block.tobytes()), header=None, names=header, usecols=usecols, **CSV_OPTIONS)
+    except pd.errors.EmptyDataError:
+        return None
+
+    return prepare_table(table) if len(table) else None
+
+def concat_tables(tables):
+    """
+    Stack tables parsed from consecutive parts of a city file.
+
+    Text columns are merged as categoricals: the categories of all parts are
+    merged into one sorted list and each part's codes are moved onto it, so no
+    per-row strings are created.
+
+    Args:
+    tables (list): The tables, in file order.
+
+    Returns:
+    DataFrame: One table, with its rows numbered from 0.
+    """
+    if len(tables) == 1:
+        return tables[0]
+
+    columns = {}
+    for name in tables[0].columns:
+        parts = [table[name] for table in tables]
+        if name in STRING_COLUMNS:
+            categoricals = [part.array if isinstance(part.dtype, pd.CategoricalDtype) else pd.Categorical(part)
+                            for part in parts]
+            names = np.unique(np.concatenate([np.asarray(part.categories, dtype=str) for part in categoricals]))
+            codes = [np.searchsorted(names, np.asarray(part.categories, dtype=str))[part.codes]
+                     for part in categoricals]
+            columns[name] = pd.Categorical.from_codes(np.concatenate(codes), names)
+        else:
+            columns[name] = np.concatenate([part.to_numpy() for part in parts])
+
+    return pd.DataFrame(columns)
+
+def read_city_chunks(file_path, chunk_size=CHUNK_SIZE, columns=None):
+    """
+    Read a city CSV file as a sequence of typed tables, a chunk of rows at a time.
+
+    Only one chunk is held in memory at a time, so files larger than RAM can
+    be streamed through stream_statistics.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    chunk_size (int): Number of rows in each chunk.
+    columns (list): The CSV columns to parse, or None for all of them. 'Start
+    Time' is always parsed, since the month, day and hour are derived from it.
+
+    Yields:
+    DataFrame: Tables in the form returned by read_city_table.
+    """
+    # Size the blocks of bytes to hold about chunk_size rows each, going by the first rows.
+    with open(file_path, 'rb') as data:
+        sample = data.read(1 << 16)
+    line_length = len(sample) / max(sample.count(b'\n'), 1)
+
+    blocks = read_city_blocks(file_path, max(int(chunk_size * line_length), 1), columns)
+    while True:
+        # Time the parsing of each chunk, but not the caller's work on it.
+        with profiler.stage('load') as stage:
+            chunk = next(blocks, None)
+            if chunk is not None:
+                stage['rows'] = len(chunk)
+
+        if chunk is None:
+            return
+        yield chunk
+
+def split_byte_ranges(file_path, parts):
+    """
+    Split the rows of a city file into byte ranges of about equal size.
+
+    Every range starts at the beginning of a row and ends just after the line
+    break that ends a row, so each one holds whole rows.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    parts (int): The number of ranges wanted.
+
+    Returns:
+    tuple: The header row (a list of column names) and a list of (start, end) byte offsets.
+    """
+    size = os.path.getsize(file_path)
+
+    with open(file_path, 'rb') as data:
+        header = next(csv.reader([data.readline().decode()]))
+        boundaries = [data.tell()]
+
+        if size > boundaries[0]:
+            with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for part in range(1, parts):
+                    # Move to an evenly spaced position, then on to the start of the next row.
+                    position = max(boundaries[0] + (size - boundaries[0]) * part // parts - 1, boundaries[-1])
+                    boundary = row_end(mapped, boundaries[-1], position, size)
+                    if boundary >= size:
+                        break
+                    if boundary > boundaries[-1]:
+                        boundaries.append(boundary)
+
+    boundaries.append(size)
+    return header, [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+def read_byte_range(file_path, start, end):
+    """
+    Read the rows in a byte range of a city file into a typed table.
+
+    The range is parsed like read_city_table parses a whole file, a block at a time by scan_block.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    start (int): Offset of the first byte of the range.
+    end (int): Offset just past the last byte of the range.
+
+    Returns:
+    DataFrame: The rows in the form returned by read_city_table, numbered from 0
+    (with no columns if the range holds no rows).
+    """
+    tables = list(read_city_blocks(file_path, SCAN_BLOCK_SIZE, start=start, end=end))
+    return concat_tables(tables) if tables else pd.DataFrame()
+
+def cube_byte_range(file_path, start, end):
+    """
+    Aggregate the rows in a byte range of a city file into a cube (run in a worker process).
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    start (int): Offset of the first byte of the range.
+    end (int): Offset just past the last byte of the range.
+
+    Returns:
+    dict: The cube of the rows, as returned by build_cube, or None if the range holds no rows.
+    """
+    return stream_cube(read_city_blocks(file_path, SCAN_BLOCK_SIZE, start=start, end=end))
+
+def read_city_table_parallel(file_path, workers=None):
+    """
+    Read a city CSV file into a typed columnar table, parsing parts of the file in parallel.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    workers (int): The number of worker processes, or None for one per CPU.
+
+    Returns:
+    DataFrame: The same table as read_city_table.
+    """
+    workers = workers or os.cpu_count()
+    _, ranges = split_byte_ranges(file_path, workers)
+    if not ranges:
+        return read_city_table(file_path)
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        tables = list(pool.map(read_byte_range, *zip(*[(file_path, start, end) for start, end in ranges])))
+
+    # Number the rows from 0 across all parts, like read_city_table does, and
+    # encode the stations of all parts against one dictionary again.
+    return encode_stations(concat_tables(tables))
+
+def build_city_cube(file_path, workers=1):
+    """
+    Build the aggregate cube of a city CSV file, optionally aggregating parts of the file in parallel.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    workers (int): The number of processes parsing and aggregating the file (1 to
+    stream it through this process, None for one per CPU).
+
+    Returns:
+    dict: The cube of the file, as returned by build_cube.
+    """
+    if workers == 1:
+        cube = stream_cube(read_city_chunks(file_path))
+    else:
+        workers = workers or os.cpu_count()
+        _, ranges = split_byte_ranges(file_path, workers)
+        cube = None
+        if ranges:
+            with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                for part in pool.map(cube_byte_range, *zip(*[(file_path, start, end) for start, end in ranges])):
+                    if part is not None:
+                        cube = part if cube is None else merge_cubes(cube, part)
+
+    if cube is None:
+        # A file with no rows.
+        cube = build_cube(read_city_table(file_path))
+
+    return cube
+
+def prepare_table(table):
+    """
+    Convert the columns of a freshly read city CSV file to their native types.
+
+    Args:
+    table (DataFrame): The raw columns read by pandas with CSV_OPTIONS.
+
+    Returns:
+    DataFrame: The typed table, with the derived month, day and hour columns.
+    """
+    # Drop the unnamed trip id column (the first column of every city file),
+    # unless only some of the columns were read.
+    table = table.drop(columns=[name for name in table.columns if not name or name.startswith('Unnamed')])
+
+    # Convert the time and numeric columns to their native types.
+    start_times = decode_timestamps(table['Start Time'])
+    table['Start Time'] = start_times['time']
+    if 'End Time' in table:
+        table['End Time'] = decode_timestamps(table['End Time'])['time']
+    if 'Trip Duration' in table:
+        table['Trip Duration'] = table['Trip Duration'].astype('float64')
+    if 'Birth Year' in table:
+        table['Birth Year'] = pd.to_numeric(table['Birth Year'], errors='coerce')
+
+    # Add month (1-12), day of the week (0=Monday) and hour as integer columns.
+    table['month'] = start_times['month']
+    table['day_of_week'] = start_times['day_of_week']
+    table['hour'] = start_times['hour']
+
+    if all(name in table for name in STATION_COLUMNS):
+        table = encode_stations(table)
+
+    return table
+
+def encode_stations(table):
+    """
+    Store the station columns as integer codes into one sorted dictionary of station names.
+
+    Both columns become categoricals with the same categories, so a station has
+    the same code whether a trip starts or ends there, and station and route
+    counts can be taken over the codes without touching any strings.
+
+    Args:
+    table (DataFrame): A table with 'Start Station' and 'End Station' columns.
+
+    Returns:
+    DataFrame: The same table, with the station columns encoded.
+    """
+    station_names, station_codes = encode_text_columns(*[table[name] for name in STATION_COLUMNS])
+    for name, codes in zip(STATION_COLUMNS, station_codes):
+        table[name] = pd.Categorical.from_codes(codes, station_names)
+
+    return table
+
+def decode_timestamps(column):
+    """
+    Decode a column of 'YYYY-MM-DD HH:MM:SS' timestamps.
+
+    Every field sits at a fixed offset, so the timestamps are decoded by slicing
+    out the digits of all rows at once. Each calendar day is only converted to
+    a day number and weekday once, however many trips start on it. Columns that
+    do not follow the format exactly go through pandas' generic parser instead.
+
+    Args:
+    column (Series): The timestamps as strings.
+
+    Returns:
+    dict: The 'time' as datetime64 values, and its 'month' (1-12),
+    'day_of_week' (0=Monday) and 'hour' as int8 arrays.
+    """
+    try:
+        # One row of 20 bytes per timestamp; the 20th byte is zero if the text is 19 long.
+        chars = np.asarray(column, dtype='S20').view('uint8').reshape(-1, 20)
+    except (UnicodeEncodeError, ValueError):
+        chars = None
+
+    if chars is None or not is_timestamp_layout(chars):
+        times = pd.to_datetime(column, format=TIME_FORMAT)
+
+        # pandas takes seconds of 60 and 61 (leap seconds) and rolls them over; strptime rejects them.
+        text = pd.Series(column).astype(str)
+        seconds = pd.to_numeric(text.str.rsplit(':', n=1).str[-1], errors='coerce')
+        if (seconds >= 60).any():
+            raise ValueError(f"second must be in 0..59 in time data {text[seconds >= 60].iloc[0]!r}")
+
+        return {'time': times.to_numpy(), 'month': times.dt.month.to_numpy().astype('int8'),
+                'day_of_week': times.dt.dayofweek.to_numpy().astype('int8'),
+                'hour': times.dt.hour.to_numpy().astype('int8')}
+
+    return decode_timestamp_chars(chars)
+
+def decode_timestamp_chars(chars):
+    """
+    Decode timestamps already checked by is_timestamp_layout.
+
+    Args:
+    chars (ndarray): The bytes of the timestamps, one row of 20 per timestamp.
+
+    Returns:
+    dict: As returned by decode_timestamps.
+    """
+    year = digits_at(chars, 0, 4)
+    month = digits_at(chars, 5, 7)
+    day = digits_at(chars, 8, 10)
+    hour = digits_at(chars, 11, 13)
+    seconds = hour * 3600 + digits_at(chars, 14, 16) * 60 + digits_at(chars, 17, 19)
+
+    # Look up each calendar day in a small table holding every month of the
+    # years present as 31 slots, filled in only for the days that occur.
+    first_year = int(year.min()) if len(year) else 0
+    slots = (year - first_year) * 372 + (month - 1) * 31 + (day - 1)
+    day_numbers, weekdays = calendar_days(np.flatnonzero(np.bincount(slots, minlength=1)), first_year)
+    days = day_numbers[slots]
+
+    return {'time': (days * 86400 + seconds).view('datetime64[s]'),
+            'month': month.astype('int8'),
+            'day_of_week': weekdays[slots],
+            'hour': hour.astype('int8')}
+
+def is_timestamp_layout(chars):
+    """
+    Check that every timestamp is exactly 'DDDD-DD-DD DD:DD:DD' (D being a digit), with every field in range.
+
+    decode_timestamp_chars adds the fields up without checking them, so an
+    hour of 25 or a month of 13 would silently roll over; such timestamps are
+    left to pandas, which rejects them. Days past the end of their month
+    (e.g. February 30) are rejected by calendar_days.
+
+    Args:
+    chars (ndarray): The bytes of the timestamps, one row of 20 per timestamp.
+
+    Returns:
+    bool: True if every row has the layout, with nothing after it, a month of
+    1-12, a day of 1-31, an hour below 24 and minutes and seconds below 60.
+    """
+    separators = np.frombuffer(b'-- ::', dtype='uint8')
+    separator_columns = [4, 7, 10, 13, 16]
+    digit_columns = [column for column in range(19) if column not in separator_columns]
+
+    digits = chars[:, digit_columns]
+    if not ((chars[:, separator_columns] == separators).all()
+            and ((digits >= ord('0')) & (digits <= ord('9'))).all()
+            and (chars[:, 19] == 0).all()):
+        return False
+
+    month = digits_at(chars, 5, 7)
+    day = digits_at(chars, 8, 10)
+    return bool(((month >= 1) & (month <= 12)).all()
+                and ((day >= 1) & (day <= 31)).all()
+                and (digits_at(chars, 11, 13) < 24).all()
+                and (digits_at(chars, 14, 16) < 60).all()
+                and (digits_at(chars, 17, 19) < 60).all())
+
+def digits_at(chars, start, stop):
+    """
+    Read the number written in a fixed range of columns of every timestamp.
+
+    Args:
+    chars (ndarray): The bytes of the timestamps, one row per timestamp.
+    start (int): The column of the first digit.
+    stop (int): The column just past the last digit.
+
+    Returns:
+    ndarray: The numbers as int32.
+    """
+    number = np.zeros(len(chars), dtype='int32')
+    for column in range(start, stop):
+        number = number * 10 + (chars[:, column] - ord('0'))
+
+    return number
+
+def calendar_days(slots, first_year):
+    """
+    Convert (year, month, day) slots of decode_timestamps into day numbers and weekdays.
+
+    Args:
+    slots (ndarray): The slots in use, as (year - first_year) * 372 + (month - 1) * 31 + (day - 1).
+    first_year (int): The year of slot 0.
+
+    Returns:
+    tuple: Arrays indexed by slot of the day number (days since 1970-01-01) and
+    weekday (0=Monday). Slots not in use are left at 0.
+
+    Raises:
+    ValueError: If a slot is not a real date, e.g. February 30.
+    """
+    size = int(slots.max()) + 1 if len(slots) else 1
+    day_numbers = np.zeros(size, dtype='int64')
+    weekdays = np.zeros(size, dtype='int8')
+    epoch = date(1970, 1, 1).toordinal()
+
+    for slot in slots.tolist():
+        years, day_of_year = divmod(slot, 372)
+        calendar_day = date(first_year + years, day_of_year // 31 + 1, day_of_year % 31 + 1)
+        day_numbers[slot] = calendar_day.toordinal() - epoch
+        weekdays[slot] = calendar_day.weekday()
+
+    return day_numbers, weekdays
+
+def filter_mask(table, month_filter, day_filter):
+    """
+    Build a boolean mask selecting the rows that match the month and day filters.
+
+    Args:
+    table (DataFrame): A table returned by read_city_table.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+
+    Returns:
+    ndarray: A boolean array with one entry per row of the table.
+    """
+    mask = np.ones(len(table), dtype=bool)
+
+    if month_filter != 'All':
+        mask &= table['month'].to_numpy() == MONTH_NAMES.index(month_filter) + 1
+
+    if day_filter != 'All':
+        mask &= table['day_of_week'].to_numpy() == DAY_NAMES.index(day_filter)
+
+    return mask
+
+def load_city_table(file_path, workers=None):
+    """
+    Load the columnar table for a city file, using the on-disk cache when it is current.
+
+    The cache is built the first time a file is read. When the file changes,
+    rows appended to it since are parsed and added to the cached table; any
+    other change (a truncated or rewritten file) rebuilds the cache.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    workers (int): The number of processes parsing the file if the cache must be
+    rebuilt (1 to parse it in this process, 0 for one per CPU), or None for PARSE_WORKERS.
+
+    Returns:
+    DataFrame: The table returned by read_city_table for this file.
+    """
+    cache_path = cache_file_path(file_path, 'table')
+    signature = file_signature(file_path)
+
+    table = read_cached_table(cache_path, signature)
+    if table is None:
+        table = update_cached_table(file_path, cache_path)
+        workers = PARSE_WORKERS if workers is None else workers
+        if table is None:
+            if workers == 1:
+                table = read_city_table(file_path)
+            else:
+                table = read_city_table_parallel(file_path, workers or None)
+        write_cached_table(cache_path, table, signature, ingest_state(file_path, signature[2], len(table)))
+
+    return table
+
+def update_cached_table(file_path, cache_path):
+    """
+    Bring an out-of-date cached table up to date by parsing only the rows appended to the file.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    cache_path (str): Path of the table's '.npz' cache file.
+
+    Returns:
+    DataFrame: The table of the whole file, or None if the file was not only
+    appended to (or there is no cache), so the table must be rebuilt.
+    """
+    cache = read_cache_file(cache_path, None)
+    appended_rows = read_appended_rows(file_path, cache)
+    if appended_rows is None:
+        return None
+
+    table = table_from_cache(cache)
+    if len(appended_rows) > 0:
+        # Number the new rows after the cached ones and encode the stations of
+        # both against one sorted dictionary again.
+        table = encode_stations(concat_tables([table, appended_rows]))
+
+    return table
+
+def ingest_state(file_path, size, rows):
+    """
+    Record how much of a city file a cache was built from, so appended rows can be told apart later.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    size (int): The size of the file when it was read.
+    rows (int): The number of rows read.
+
+    Returns:
+    ndarray: The size, the row count and a checksum of the bytes read.
+    """
+    return np.array([size, rows, ingest_checksum(file_path, size)], dtype='int64')
+
+# Checksums of the first bytes of city files, as {file path: (file signature,
+# {number of bytes: CRC-32})}, kept while each file is unchanged.
+prefix_checksums = {}
+
+def ingest_checksum(file_path, size):
+    """
+    Checksum the first `size` bytes of a file.
+
+    Every byte counts, so an edit anywhere in the part of the file a cache was
+    built from is caught, even one that leaves the file's size unchanged.
+
+    Checksums are remembered while the file is unchanged, and a longer
+    prefix is checksummed by extending the longest shorter one known. So the
+    table and the cube of a file verify its old rows with one read, and
+    after rows are appended only the new bytes are read to checksum the
+    whole file again.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    size (int): The number of bytes of the file to consider.
+
+    Returns:
+    int: The CRC-32 of those bytes.
+    """
+    signature = file_signature(file_path)
+    if file_path not in prefix_checksums or not np.array_equal(prefix_checksums[file_path][0], signature):
+        prefix_checksums[file_path] = (signature, {0: 0})
+    checksums = prefix_checksums[file_path][1]
+
+    if size not in checksums:
+        start = max(known for known in checksums if known <= size)
+        checksum = checksums[start]
+        with open(file_path, 'rb') as data:
+            data.seek(start)
+            remaining = size - start
+            while remaining > 0:
+                block = data.read(min(remaining, INGEST_CHECK_BYTES))
+                if not block:
+                    break
+                checksum = zlib.crc32(block, checksum)
+                remaining -= len(block)
+        checksums[size] = checksum
+
+    return checksums[size]
+
+def appended_range(file_path, cache):
+    """
+    Find the bytes appended to a city file since a cache was built from it.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    cache (dict): The cache's arrays, from read_cache_file, or None.
+
+    Returns:
+    tuple: The (start, end) offsets of the appended bytes (empty if nothing was
+    appended), or None if the file was truncated or rewritten since, so the
+    cache must be rebuilt.
+    """
+    if cache is None or 'ingested' not in cache:
+        return None
+
+    size, _, checksum = cache['ingested'].tolist()
+    current_size = os.path.getsize(file_path)
+    if current_size < size:
+        # Truncated.
+        return None
+
+    with open(file_path, 'rb') as data:
+        # Rows appended to a file whose last row had no line break would be
+        # glued onto that row, so only a file ending in a line break qualifies.
+        data.seek(max(size - 1, 0))
+        if data.read(1) != b'\n':
+            return None
+
+    if ingest_checksum(file_path, size) != checksum:
+        # Rewritten.
+        return None
+
+    return size, current_size
+
+def read_appended_rows(file_path, cache):
+    """
+    Read the rows appended to a city file since a cache was built from it.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    cache (dict): The cache's arrays, from read_cache_file, or None.
+
+    Returns:
+    DataFrame: The appended rows in the form returned by read_city_table
+    (possibly none), or None if the cache must be rebuilt.
+    """
+    byte_range = appended_range(file_path, cache)
+    if byte_range is None:
+        return None
+
+    start, end = byte_range
+    with profiler.stage('load appended') as stage:
+        appended_rows = read_byte_range(file_path, start, end)
+        stage['rows'] = len(appended_rows)
+
+    return appended_rows
+
+def cache_file_path(file_path, kind):
+    """
+    Return the path of a cache file for a city file.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    kind (str): What the cache file holds, e.g. 'table' or 'cube'.
+
+    Returns:
+    str: Path of the '.npz' cache file in the cache directory next to the city file.
+    """
+    directory, file_name = os.path.split(file_path)
+    return os.path.join(directory, CACHE_DIR, f'{os.path.splitext(file_name)[0]}.{kind}.npz')
+
+def file_signature(file_path):
+    """
+    Describe the current state of a file so that stale caches can be detected.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+
+    Returns:
+    ndarray: The cache version, the file's modification time (ns) and its size.
+    """
+    stat = os.stat(file_path)
+    return np.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype='int64')
+
+def read_cache_file(cache_path, signature):
+    """
+    Read the arrays of a cache file if it was built from the current version of the file.
+
+    Args:
+    cache_path (str): Path of the '.npz' cache file.
+    signature (ndarray): The current signature of the city file, from file_signature,
+    or None to read a cache built from any version of the file (by this version of the program).
+
+    Returns:
+    dict: The cached arrays by name, or None if there is no usable cache.
+    """
+    cache = open_cache_file(cache_path, signature)
+    if cache is None:
+        return None
+
+    try:
+        with cache:
+            return {name: cache[name] for name in cache.files}
+    except CACHE_ERRORS:
+        return None
+
+def open_cache_file(cache_path, signature):
+    """
+    Open a cache file without reading its arrays, if it was built from the current version of the file.
+
+    Args:
+    cache_path (str): Path of the '.npz' cache file.
+    signature (ndarray): As for read_cache_file.
+
+    Returns:
+    NpzFile: The open cache file, whose arrays are each read when first
+    accessed, or None if there is no usable cache. Close it after use.
+    """
+    # A missing or damaged cache file is no usable cache; it is rebuilt.
+    try:
+        cache = np.load(cache_path)
+    except CACHE_ERRORS:
+        return None
+
+    try:
+        usable = ('signature' in cache.files
+                  and (signature is not None or cache['signature'][0] == CACHE_VERSION)
+                  and (signature is None or np.array_equal(cache['signature'], signature)))
+    except CACHE_ERRORS:
+        usable = False
+
+    if not usable:
+        cache.close()
+        return None
+
+    return cache
+
+def write_cache_file(cache_path, arrays, signature):
+    """
+    Save arrays to a cache file, tagged with the signature of the file they were built from.
+
+    Args:
+    cache_path (str): Path of the '.npz' cache file.
+    arrays (dict): The arrays to save, by name.
+    signature (ndarray): The signature of the city file, from file_signature.
+    """
+    # Write to a temporary file of this writer's own first, so a partly
+    # written cache is never read and writers of the same cache never mix.
+    temp_path = None
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(cache_path) + '.',
+                                             dir=os.path.dirname(cache_path))
+        with os.fdopen(handle, 'wb') as cache_file:
+            np.savez(cache_file, signature=signature, **arrays)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # The cache is only an optimization, so carry on without it.
+        if temp_path is not None:
+            with suppress(OSError):
+                os.remove(temp_path)
+
+def read_cached_table(cache_path, signature):
+    """
+    Read a table from the cache if it was built from the current version of the file.
+
+    Args:
+    cache_path (str): Path of the '.npz' cache file.
+    signature (ndarray): The current signature of the city file, from file_signature.
+
+    Returns:
+    DataFrame: The cached table, or None if there is no usable cache.
+    """
+    cache = read_cache_file(cache_path, signature)
+    if cache is None:
+        return None
+
+    return table_from_cache(cache)
+
+def table_from_cache(cache, columns=None, rows=None):
+    """
+    Rebuild a table, or some of its columns and rows, from the arrays of its cache file.
+
+    Args:
+    cache (dict): The arrays, from read_cache_file, or an open cache file from open_cache_file.
+    columns (list): The columns to rebuild, or None for every column.
+    rows (ndarray): A boolean mask of the rows to keep, or None for every row.
+
+    Returns:
+    DataFrame: The table, in the form returned by read_city_table, indexed by
+    row number in the file.
+    """
+    names = cache['columns'].tolist() if columns is None else columns
+
+    table = {}
+    for name in names:
+        if name in STRING_COLUMNS:
+            # Rebuild text columns as categoricals so no per-row strings are allocated.
+            codes = cache[name + ':codes']
+            table[name] = pd.Categorical.from_codes(codes if rows is None else codes[rows], cache[dictionary_key(name)])
+        else:
+            table[name] = cache[name] if rows is None else cache[name][rows]
+
+    if rows is not None:
+        index = np.flatnonzero(rows)
+    else:
+        index = pd.RangeIndex(len(cache['month']))
+
+    return pd.DataFrame(table, index=index)
+
+def write_cached_table(cache_path, table, signature, ingested):
+    """
+    Save a table to the cache, tagged with the signature of the file it was read from.
+
+    Args:
+    cache_path (str): Path of the '.npz' cache file.
+    table (DataFrame): The table returned by read_city_table.
+    signature (ndarray): The signature of the city file, from file_signature.
+    ingested (ndarray): How much of the file the table holds, from ingest_state.
+    """
+    arrays = {'columns': np.array(table.columns, dtype=str), 'ingested': ingested}
+
+    for name in table.columns:
+        if name in STRING_COLUMNS:
+            # Store text columns as int32 codes into a list of distinct values.
+            if isinstance(table[name].dtype, pd.CategoricalDtype):
+                codes, names = table[name].cat.codes.to_numpy(), table[name].cat.categories
+            else:
+                codes, names = pd.factorize(table[name])
+            arrays[name + ':codes'] = codes.astype('int32')
+            arrays[dictionary_key(name)] = np.array(names, dtype=str)
+        else:
+            arrays[name] = table[name].to_numpy()
+
+    write_cache_file(cache_path, arrays, signature)
+
+def dictionary_key(name):
+    """
+    Return the name under which the distinct values of a text column are cached.
+
+    Args:
+    name (str): The name of the text column.
+
+    Returns:
+    str: 'station_names' for the station columns, which share one dictionary,
+    and '<name>:names' for the other text columns.
+    """
+    return 'station_names' if name in STATION_COLUMNS else name + ':names'
+
+def load_city_cube(file_path, workers=None):
+    """
+    Load the aggregate cube for a city file, using the on-disk cache when it is current.
+
+    Rows appended to the file since the cube was built are aggregated on their
+    own and merged into the cached cube; any other change rebuilds the cube.
+    Cubes are built from the CSV file a chunk of rows at a time, so the
+    whole file is never held in memory.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    workers (int): The number of processes parsing the file if the cube must be
+    rebuilt (1 to parse it in this process, 0 for one per CPU), or None for PARSE_WORKERS.
+
+    Returns:
+    dict: The cube returned by build_cube for this file.
+    """
+    cache_path = cache_file_path(file_path, 'cube')
+    signature = file_signature(file_path)
+
+    cube = read_cache_file(cache_path, signature)
+    if cube is None:
+        cube = update_cached_cube(file_path, cache_path)
+        if cube is None:
+            workers = PARSE_WORKERS if workers is None else workers
+            cube = build_city_cube(file_path, workers or None)
+        ingested = ingest_state(file_path, signature[2], int(cube['trip_counts'].sum()))
+        write_cache_file(cache_path, dict(cube, ingested=ingested), signature)
+
+    return cube
+
+def update_cached_cube(file_path, cache_path):
+    """
+    Bring an out-of-date cached cube up to date by aggregating only the rows appended to the file.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+    cache_path (str): Path of the cube's '.npz' cache file.
+
+    Returns:
+    dict: The cube of the whole file, or None if the file was not only
+    appended to (or there is no cache), so the cube must be rebuilt.
+    """
+    cache = read_cache_file(cache_path, None)
+    appended_rows = read_appended_rows(file_path, cache)
+    if appended_rows is None:
+        return None
+
+    cube = {name: array for name, array in cache.items() if name not in ['signature', 'ingested']}
+    if len(appended_rows) > 0:
+        cube = merge_cubes(cube, build_cube(appended_rows))
+
+    return cube
+
+def stream_cube(chunks):
+    """
+    Build an aggregate cube one chunk of rows at a time.
+
+    Each chunk is aggregated by build_cube and merged into the cube of the
+    chunks before it, so only one chunk is held in memory at a time.
+
+    Args:
+    chunks (iterable): Tables in the form returned by read_city_table, e.g. from read_city_chunks.
+
+    Returns:
+    dict: The cube of all the rows, as returned by build_cube, or None if there are no chunks.
+    """
+    cube = None
+    for chunk in chunks:
+        chunk_cube = build_cube(chunk)
+        cube = chunk_cube if cube is None else merge_cubes(cube, chunk_cube)
+
+    return cube
+
+def build_cube(table):
+    """
+    Precompute the aggregates behind every statistic for each month and day of the week.
+
+    Trip counts and duration sums are kept per month x weekday x hour, which is
+    enough to rebuild the month, day and hour modes of any filter. Everything
+    else is only ever filtered by month and day, so it is kept per month x weekday:
+    station, user type and gender counts and a histogram of birth years. The
+    most popular route is precomputed for every month/day filter combination,
+    because route counts do not fit in a dense array.
+
+    Args:
+    table (DataFrame): A table returned by read_city_table.
+
+    Returns:
+    dict: The cube's arrays by name.
+    """
+    # Each trip falls into one of 12 x 7 (month, weekday) cells.
+    cells = (table['month'].to_numpy().astype('int64') - 1) * 7 + table['day_of_week'].to_numpy()
+    cell_count = 12 * 7
+
+    cube = {}
+
+    # Trip counts and duration sums per (month, weekday, hour).
+    hour_cells = cells * 24 + table['hour'].to_numpy()
+    cube['trip_counts'] = np.bincount(hour_cells, minlength=cell_count * 24).reshape(12, 7, 24)
+    duration_sums = np.bincount(hour_cells, weights=duration_milliseconds(table['Trip Duration']),
+                                minlength=cell_count * 24)
+    cube['duration_ms'] = duration_sums.astype('int64').reshape(12, 7, 24)
+
+    # Start and end station counts per (month, weekday).
+    station_names, (start_codes, end_codes) = encode_text_columns(table['Start Station'], table['End Station'])
+    station_count = len(station_names)
+    cube['station_names'] = station_names
+    cube['start_counts'] = cell_counts(cells, start_codes, station_count)
+    cube['end_counts'] = cell_counts(cells, end_codes, station_count)
+
+    # Route counts per (month, weekday), kept as a sparse list of (cell, route) pairs.
+    route_keys = start_codes * station_count + end_codes
+    cell_routes, route_counts = np.unique(cells * station_count ** 2 + route_keys, return_counts=True)
+    cube['route_cells'], cube['route_keys'] = np.divmod(cell_routes, station_count ** 2)
+    cube['route_counts'] = route_counts
+
+    cube['route_modes'] = popular_routes(cube['route_cells'], cube['route_keys'], cube['route_counts'],
+                                         station_count)
+
+    # User type counts per (month, weekday).
+    user_type_names, (user_type_codes,) = encode_text_columns(table['User Type'])
+    cube['user_type_names'] = user_type_names
+    cube['user_type_counts'] = cell_counts(cells, user_type_codes, len(user_type_names))
+
+    # Gender and birth year data (Only available for some cities)
+    if 'Gender' in table:
+        gender_names, (gender_codes,) = encode_text_columns(table['Gender'])
+        cube['gender_names'] = gender_names
+        cube['gender_counts'] = cell_counts(cells, gender_codes, len(gender_names))
+
+    if 'Birth Year' in table:
+        birth_years = table['Birth Year'].to_numpy()
+        valid = ~np.isnan(birth_years)
+        first_year = int(birth_years[valid].min()) if valid.any() else 0
+        year_offsets = birth_years[valid].astype('int64') - first_year
+        cube['first_birth_year'] = np.array(first_year)
+        cube['birth_year_counts'] = cell_counts(cells[valid], year_offsets, int(year_offsets.max(initial=-1)) + 1)
+
+    return cube
+
+def popular_routes(route_cells, route_keys, route_counts, station_count):
+    """
+    Find the most popular route for every month/day filter combination.
+
+    Args:
+    route_cells (ndarray): The (month, weekday) cell of each route count.
+    route_keys (ndarray): The route of each count, as start_code * station_count + end_code.
+    route_counts (ndarray): The number of trips of each route in its cell.
+    station_count (int): Number of distinct station names.
+
+    Returns:
+    ndarray: A 13 x 8 x 3 array of (start code, end code, count), where month
+    and day index 0 mean 'All'.
+    """
+    route_modes = np.zeros((13, 8, 3), dtype='int64')
+    route_months = route_cells // 7 + 1
+    route_days = route_cells % 7 + 1
+
+    # The pairs are sorted by cell and then route, so each single (month, day)
+    # cell is a slice holding each of its routes once, in code order.
+    cell_bounds = np.searchsorted(route_cells, np.arange(12 * 7 + 1))
+
+    # Filters spanning several cells add up the counts of each route, found
+    # once here as a position in the sorted list of distinct routes.
+    distinct_keys, key_positions = np.unique(route_keys, return_inverse=True)
+
+    for month in range(13):
+        for day in range(8):
+            if month and day:
+                cell = (month - 1) * 7 + day - 1
+                keys = route_keys[cell_bounds[cell]:cell_bounds[cell + 1]]
+                totals = route_counts[cell_bounds[cell]:cell_bounds[cell + 1]]
+            else:
+                selected = ((month == 0) | (route_months == month)) & ((day == 0) | (route_days == day))
+                keys = distinct_keys
+                totals = np.bincount(key_positions[selected], weights=route_counts[selected],
+                                     minlength=len(distinct_keys)).astype('int64')
+
+            # Ties go to the lowest route key, like most_common_route.
+            if len(totals) and totals.max() > 0:
+                best = int(np.argmax(totals))
+                route_modes[month, day] = (*divmod(int(keys[best]), station_count), int(totals[best]))
+
+    return route_modes
+
+def merge_cubes(cube, appended):
+    """
+    Combine the cubes of two sets of trips into the cube of all of them.
+
+    Counts and sums are added up. The name lists (stations, user types,
+    genders) are merged into one sorted list and both cubes' counts are moved
+    to the merged positions, routes are re-encoded against the merged station
+    list, and the birth year histograms are aligned on the earlier first year.
+
+    Args:
+    cube (dict): A cube returned by build_cube.
+    appended (dict): The cube of further trips of the same city.
+
+    Returns:
+    dict: The cube of both sets of trips, as build_cube would return for them.
+    """
+    merged = {name: cube[name] + appended[name] for name in ['trip_counts', 'duration_ms']}
+
+    for names, counts in [('station_names', ['start_counts', 'end_counts']),
+                          ('user_type_names', ['user_type_counts']),
+                          ('gender_names', ['gender_counts'])]:
+        if names not in cube:
+            continue
+        merged[names], positions, appended_positions = merge_names(cube[names], appended[names])
+        for name in counts:
+            merged[name] = (remap_counts(cube[name], positions, len(merged[names]))
+                            + remap_counts(appended[name], appended_positions, len(merged[names])))
+
+    # Re-encode both cubes' routes against the merged station list, then add up
+    # the counts of the (cell, route) pairs found in both.
+    station_count = len(merged['station_names'])
+    cells, keys, counts = [], [], []
+    for source in [cube, appended]:
+        positions = np.searchsorted(merged['station_names'], source['station_names'])
+        start_codes, end_codes = np.divmod(source['route_keys'], len(source['station_names']))
+        cells.append(source['route_cells'])
+        keys.append(positions[start_codes].astype('int64') * station_count + positions[end_codes])
+        counts.append(source['route_counts'])
+    cell_routes, inverse = np.unique(np.concatenate(cells) * station_count ** 2 + np.concatenate(keys),
+                                     return_inverse=True)
+    merged['route_cells'], merged['route_keys'] = np.divmod(cell_routes, station_count ** 2)
+    merged['route_counts'] = np.bincount(inverse, weights=np.concatenate(counts)).astype('int64')
+    merged['route_modes'] = popular_routes(merged['route_cells'], merged['route_keys'], merged['route_counts'],
+                                           station_count)
+
+    if 'birth_year_counts' in cube:
+        # A histogram without any birth year has an arbitrary first year, so it does not count.
+        histograms = [(int(source['first_birth_year']), source['birth_year_counts'])
+                      for source in [cube, appended] if source['birth_year_counts'].shape[-1] > 0]
+        first_year = min((year for year, _ in histograms), default=0)
+        year_count = max((year - first_year + counts.shape[-1] for year, counts in histograms), default=0)
+        birth_year_counts = np.zeros((12, 7, year_count), dtype='int64')
+        for year, counts in histograms:
+            birth_year_counts[:, :, year - first_year:year - first_year + counts.shape[-1]] += counts
+        merged['first_birth_year'] = np.array(first_year)
+        merged['birth_year_counts'] = birth_year_counts
+
+    return merged
+
+def merge_names(names, appended_names):
+    """
+    Merge two sorted lists of names.
+
+    Args:
+    names (ndarray): The first list.
+    appended_names (ndarray): The second list.
+
+    Returns:
+    tuple: The merged, sorted list and the position in it of each name of
+    the first and of the second list.
+    """
+    merged_names = np.union1d(np.asarray(names, dtype=str), np.asarray(appended_names, dtype=str))
+    return (merged_names, np.searchsorted(merged_names, names).astype('int64'),
+            np.searchsorted(merged_names, appended_names).astype('int64'))
+
+def remap_counts(counts, positions, size):
+    """
+    Move counts of codes (along the last axis) to new code positions.
+
+    Args:
+    counts (ndarray): A 12 x 7 x code_count array of counts.
+    positions (ndarray): The new position of each code.
+    size (int): The new number of codes.
+
+    Returns:
+    ndarray: A 12 x 7 x size array of counts.
+    """
+    remapped = np.zeros(counts.shape[:-1] + (size,), dtype='int64')
+    remapped[..., positions] = counts
+    return remapped
+
+def cube_statistics(cube, month_filter, day_filter):
+    """
+    Answer a month/day filter from an aggregate cube by summing the matching cells.
+
+    Args:
+    cube (dict): A cube returned by build_cube.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+
+    Returns:
+    dict: The statistics, in the form returned by compute_statistics.
+    """
+    # Pick the cube cells matching the filters ('All' keeps every month or day).
+    months = slice(None) if month_filter == 'All' else [MONTH_NAMES.index(month_filter)]
+    days = slice(None) if day_filter == 'All' else [DAY_NAMES.index(day_filter)]
+
+    def selected_total(array):
+        return array[months][:, days].sum(axis=(0, 1))
+
+    trip_counts = cube['trip_counts'][months][:, days]
+
+    counts = {
+        'month_counts': np.zeros(12, dtype='int64'),
+        'day_counts': np.zeros(7, dtype='int64'),
+        'hour_counts': trip_counts.sum(axis=(0, 1)),
+        'duration_ms': int(selected_total(cube['duration_ms']).sum()),
+        'station_names': cube['station_names'],
+        'start_counts': selected_total(cube['start_counts']),
+        'end_counts': selected_total(cube['end_counts']),
+        'user_type_names': cube['user_type_names'],
+        'user_type_counts': selected_total(cube['user_type_counts']),
+    }
+    counts['month_counts'][months] = trip_counts.sum(axis=(1, 2))
+    counts['day_counts'][days] = trip_counts.sum(axis=(0, 2))
+
+    month_index = 0 if month_filter == 'All' else MONTH_NAMES.index(month_filter) + 1
+    day_index = 0 if day_filter == 'All' else DAY_NAMES.index(day_filter) + 1
+    counts['route'] = tuple(cube['route_modes'][month_index, day_index])
+
+    if 'gender_counts' in cube:
+        counts['gender_names'] = cube['gender_names']
+        counts['gender_counts'] = selected_total(cube['gender_counts'])
+
+    if 'birth_year_counts' in cube:
+        counts['first_birth_year'] = int(cube['first_birth_year'])
+        counts['birth_year_counts'] = selected_total(cube['birth_year_counts'])
+
+    return summarize_counts(counts)
+
+def filter_statistics(city, month_filter, day_filter, cube=None):
+    """
+    Return the statistics of a city under a month/day filter, from the result cache when possible.
+
+    Args:
+    city (str): The city to analyze.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    cube (dict): The city's cube if it is already loaded, or None to load it on a cache miss.
+
+    Returns:
+    dict: The statistics, in the form returned by summarize_counts.
+    """
+    key = result_key(city, month_filter, day_filter, 'stats')
+    stats = result_cache.get(key)
+    if stats is not None:
+        return stats
+
+    if cube is None:
+        with profiler.stage('cube load'):
+            cube = load_city_cube(CITY_DATA[city])
+    with profiler.stage('cube query') as stage:
+        stats = cube_statistics(cube, month_filter, day_filter)
+        stage['rows'] = stats['trip_count']
+
+    result_cache.put(key, stats)
+    return stats
+
+def top_counts(counts, k, keys=None):
+    """
+    Select the k largest counts with a partial sort.
+
+    np.argpartition finds the k-th largest count without sorting the rest;
+    only the counts at least that large are then sorted. Equal counts are
+    ordered by key, so the first position is the one np.argmax would pick
+    when the keys are the positions themselves.
+
+    Args:
+    counts (ndarray): The counts.
+    k (int): The number of counts wanted.
+    keys (ndarray): The key of each count, used to break ties, or None to use the positions.
+
+    Returns:
+    ndarray: The positions of the (at most k) largest nonzero counts, largest first.
+    """
+    counts = np.asarray(counts)
+    keys = np.arange(len(counts)) if keys is None else np.asarray(keys)
+    k = min(k, int(np.count_nonzero(counts)))
+    if k <= 0:
+        return np.zeros(0, dtype='int64')
+
+    # Keep every count tied with the k-th largest, so ties can go to the lowest key.
+    kth_largest = counts[np.argpartition(counts, len(counts) - k)[len(counts) - k]]
+    candidates = np.flatnonzero(counts >= max(kth_largest, 1))
+
+    order = np.lexsort((keys[candidates], -counts[candidates]))
+    return candidates[order[:k]]
+
+def cube_top_k(cube, month_filter, day_filter, k=TOP_K):
+    """
+    Find the k most popular start stations, end stations and routes of a filter from an aggregate cube.
+
+    The counts are exact. The first entry of each list is the most popular
+    station or route reported by cube_statistics.
+
+    Args:
+    cube (dict): A cube returned by build_cube.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    k (int): The number of stations and routes wanted.
+
+    Returns:
+    dict: The trip count, and lists of (name, count) for 'start_stations' and
+    'end_stations' and of (start, end, count) for 'routes', most popular first.
+    """
+    months = slice(None) if month_filter == 'All' else [MONTH_NAMES.index(month_filter)]
+    days = slice(None) if day_filter == 'All' else [DAY_NAMES.index(day_filter)]
+    station_names = cube['station_names']
+    station_count = len(station_names)
+
+    top = {'trip_count': int(cube['trip_counts'][months][:, days].sum())}
+    for kind, name in [('start_stations', 'start_counts'), ('end_stations', 'end_counts')]:
+        counts = cube[name][months][:, days].sum(axis=(0, 1))
+        top[kind] = [(str(station_names[code]), int(counts[code])) for code in top_counts(counts, k)]
+
+    # Add up the counts of each route over the selected cells with a hash table.
+    route_months, route_days = np.divmod(cube['route_cells'], 7)
+    selected = np.ones(len(route_months), dtype=bool)
+    if month_filter != 'All':
+        selected &= route_months == MONTH_NAMES.index(month_filter)
+    if day_filter != 'All':
+        selected &= route_days == DAY_NAMES.index(day_filter)
+    positions, route_keys = pd.factorize(cube['route_keys'][selected])
+    route_counts = np.bincount(positions, weights=cube['route_counts'][selected],
+                               minlength=len(route_keys)).astype('int64')
+
+    top['routes'] = []
+    for position in top_counts(route_counts, k, route_keys):
+        start_code, end_code = divmod(int(route_keys[position]), station_count)
+        top['routes'].append((str(station_names[start_code]), str(station_names[end_code]),
+                              int(route_counts[position])))
+
+    return top
+
+def stream_top_k(chunks, k=TOP_K, month_filter='All', day_filter='All', capacity=SKETCH_CAPACITY):
+    """
+    Estimate the k most popular start stations, end stations and routes in a single pass with bounded memory.
+
+    Each chunk's counts are taken exactly and folded into a Space-Saving
+    summary, which keeps at most `capacity` counters whatever the number of
+    distinct stations or routes, and into a Count-Min sketch, which bounds the
+    estimate of every key. Summaries of separate parts of a file can be merged.
+
+    Args:
+    chunks (iterable): Tables in the form returned by read_city_table, e.g. from read_city_chunks.
+    k (int): The number of stations and routes wanted.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    capacity (int): The number of counters of each Space-Saving summary.
+
+    Returns:
+    dict: The trip count, and lists of (name, count, error) for 'start_stations'
+    and 'end_stations' and of (start, end, count, error) for 'routes', most
+    popular first. The true count of each entry lies between count - error and count.
+    """
+    summaries = {kind: (SpaceSaving(capacity), CountMinSketch())
+                 for kind in ['start_stations', 'end_stations', 'routes']}
+    trip_count = 0
+
+    for chunk in chunks:
+        chunk = chunk[filter_mask(chunk, month_filter, day_filter)]
+        trip_count += len(chunk)
+
+        station_names, (start_codes, end_codes) = encode_text_columns(chunk['Start Station'], chunk['End Station'])
+        positions, route_keys = pd.factorize(start_codes * len(station_names) + end_codes)
+        route_counts = np.bincount(positions, minlength=len(route_keys))
+        start_names, end_names = np.divmod(route_keys, len(station_names))
+
+        chunk_counts = {
+            'start_stations': pd.Series(np.bincount(start_codes, minlength=len(station_names)), index=station_names),
+            'end_stations': pd.Series(np.bincount(end_codes, minlength=len(station_names)), index=station_names),
+            'routes': pd.Series(route_counts, index=pd.MultiIndex.from_arrays([station_names[start_names],
+                                                                               station_names[end_names]])),
+        }
+        for kind, counts in chunk_counts.items():
+            counts = counts[counts > 0]
+            for summary in summaries[kind]:
+                summary.add(counts)
+
+    top = {'trip_count': trip_count}
+    for kind, (space_saving, count_min) in summaries.items():
+        entries = space_saving.top(k)
+        keys = [key for key, _, _ in entries]
+        keys = pd.MultiIndex.from_tuples(keys, names=[None, None]) if kind == 'routes' else pd.Index(keys)
+
+        top[kind] = []
+        for (key, count, error), sketch_count in zip(entries, count_min.estimate(keys)):
+            # Both summaries overestimate, so the smaller estimate is the tighter one.
+            estimate = min(count, int(sketch_count))
+            names = key if kind == 'routes' else (key,)
+            top[kind].append((*names, estimate, estimate - (count - error)))
+
+    return top
+
+class SpaceSaving:
+    """
+    Approximate counts of the most frequent keys of a stream in a fixed number
+    of counters (a Space-Saving summary).
+
+    Each counter holds an overestimate of its key's count and the most it can
+    be overestimated by (its error), so the true count lies between count -
+    error and count. Any key without a counter occurred at most `floor` times.
+    Summaries of two streams merge into a summary of both, with the same
+    guarantees.
+    """
+
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        """
+        Create an empty summary.
+
+        Args:
+        capacity (int): The maximum number of counters.
+        """
+        self.capacity = capacity
+        self.counts = pd.Series(dtype='int64')
+        self.errors = pd.Series(dtype='int64')
+        self.floor = 0
+        self.total = 0
+
+    def add(self, counts):
+        """
+        Add exact counts of a part of the stream.
+
+        Args:
+        counts (Series): The count of each key, indexed by key.
+        """
+        batch = SpaceSaving(self.capacity)
+        batch.counts = counts.astype('int64')
+        batch.errors = pd.Series(0, index=counts.index, dtype='int64')
+        batch.total = int(counts.sum())
+        batch.truncate()
+        self.merge(batch)
+
+    def merge(self, other):
+        """
+        Add the summary of another stream.
+
+        A key missing from one summary is counted as that summary's floor,
+        which is the most it can have occurred there.
+
+        Args:
+        other (SpaceSaving): The other summary.
+        """
+        if self.total == 0:
+            self.counts, self.errors, self.floor = other.counts, other.errors, other.floor
+        else:
+            keys = self.counts.index.union(other.counts.index)
+            self.counts = (self.counts.reindex(keys, fill_value=self.floor)
+                           + other.counts.reindex(keys, fill_value=other.floor))
+            self.errors = (self.errors.reindex(keys, fill_value=self.floor)
+                           + other.errors.reindex(keys, fill_value=other.floor))
+            self.floor += other.floor
+        self.total += other.total
+        self.truncate()
+
+    def truncate(self):
+        """
+        Drop the smallest counters beyond the capacity, raising the floor to the largest count dropped.
+        """
+        if len(self.counts) <= self.capacity:
+            return
+
+        kept = np.zeros(len(self.counts), dtype=bool)
+        kept[top_counts(self.counts.to_numpy(), self.capacity)] = True
+        self.floor = max(self.floor, int(self.counts.to_numpy()[~kept].max()))
+        self.counts = self.counts[kept]
+        self.errors = self.errors[kept]
+
+    def top(self, k):
+        """
+        List the keys with the highest counts.
+
+        Args:
+        k (int): The number of keys wanted.
+
+        Returns:
+        list: (key, count, error) of the k keys with the highest counts,
+        highest first, with equal counts in key order.
+        """
+        ranked = pd.DataFrame({'count': self.counts, 'error': self.errors}).sort_index()
+        ranked = ranked.sort_values('count', ascending=False, kind='stable').head(k)
+        return [(key, int(count), int(error)) for key, count, error in ranked.itertuples()]
+
+class CountMinSketch:
+    """
+    Overestimates of the count of every key of a stream in a fixed-size table
+    of counters (a Count-Min sketch).
+
+    Each key is hashed to one counter in each row of the table, and its
+    estimate is the smallest of those counters. With probability 1 - delta, an
+    estimate exceeds the true count by at most epsilon times the stream's total.
+    Sketches of the same size merge by adding their tables.
+    """
+
+    def __init__(self, epsilon=SKETCH_EPSILON, delta=SKETCH_DELTA):
+        """
+        Create an empty sketch.
+
+        Args:
+        epsilon (float): The error of the estimates, relative to the stream's total.
+        delta (float): The probability that an estimate is off by more than that.
+        """
+        self.width = int(np.ceil(np.e / epsilon))
+        self.depth = int(np.ceil(np.log(1 / delta)))
+        self.table = np.zeros((self.depth, self.width), dtype='int64')
+        self.total = 0
+
+    def columns(self, keys):
+        """
+        Hash keys to their counter in each row of the table.
+
+        Args:
+        keys (Index): The keys.
+
+        Returns:
+        ndarray: A depth x len(keys) array of counter positions.
+        """
+        # One 64-bit hash is split into two halves, which are combined into a
+        # different hash for every row.
+        hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+        rows = np.arange(self.depth, dtype='uint64')[:, None]
+        return ((hashes & 0xFFFFFFFF) + rows * (hashes >> np.uint64(32))) % np.uint64(self.width)
+
+    def add(self, counts):
+        """
+        Add counts of a part of the stream.
+
+        Args:
+        counts (Series): The count of each key, indexed by key.
+        """
+        columns = self.columns(counts.index)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(columns[row].astype('int64'), weights=counts.to_numpy(),
+                                           minlength=self.width).astype('int64')
+        self.total += int(counts.sum())
+
+    def estimate(self, keys):
+        """
+        Estimate the counts of keys.
+
+        Args:
+        keys (Index): The keys.
+
+        Returns:
+        ndarray: An overestimate of the count of each key.
+        """
+        columns = self.columns(keys).astype('int64')
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def merge(self, other):
+        """
+        Add the sketch of another stream.
+
+        Args:
+        other (CountMinSketch): A sketch with the same epsilon and delta.
+        """
+        self.table += other.table
+        self.total += other.total
+
+def top_k(city, month_filter, day_filter, k=TOP_K, approximate=False):
+    """
+    Find the k most popular start stations, end stations and routes of a city under a month/day filter.
+
+    Args:
+    city (str): The city to analyze.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    k (int): The number of stations and routes wanted.
+    approximate (bool): Stream the CSV file through Space-Saving and Count-Min
+    summaries instead of reading exact counts from the cube.
+
+    Returns:
+    dict: The lists returned by cube_top_k, or by stream_top_k if approximate.
+    """
+    if approximate:
+        chunks = read_city_chunks(CITY_DATA[city], columns=STATION_COLUMNS)
+        return stream_top_k(chunks, k, month_filter, day_filter)
+
+    return cube_top_k(load_city_cube(CITY_DATA[city]), month_filter, day_filter, k)
+
+def time_series(city, month_filter, day_filter, approximate=False, cube=None):
+    """
+    Break down the trips of a city under a month/day filter over time, and by user type.
+
+    Args:
+    city (str): The city to analyze.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    approximate (bool): Stream the CSV file and estimate the duration
+    quantiles with QuantileSketch, instead of selecting them exactly from the
+    cached table.
+    cube (dict): The city's cube if it is already loaded, or None to load it when needed.
+
+    Returns:
+    dict: The 'heatmap' of trips by weekday (rows, Monday first) and hour
+    (columns), the 'daily_trips' as (date, count) pairs, the same two for each
+    user type under 'user_types', and the 'duration_quantiles' of each user
+    type, in the form returned by stream_time_series.
+    """
+    if approximate:
+        chunks = read_city_chunks(CITY_DATA[city], columns=['Trip Duration', 'User Type'])
+        return stream_time_series(chunks, month_filter, day_filter)
+
+    key = result_key(city, month_filter, day_filter, 'time series')
+    series = result_cache.get(key)
+    if series is not None:
+        return series
+
+    # The heatmap comes from the cube, the rest from the few columns it needs.
+    if cube is None:
+        with profiler.stage('cube load'):
+            cube = load_city_cube(CITY_DATA[city])
+    trips = TripQuery(city, month_filter, day_filter).select('Start Time', 'Trip Duration', 'User Type',
+                                                             'day_of_week', 'hour').collect()
+
+    with profiler.stage('time series') as stage:
+        durations = trips['Trip Duration'].to_numpy()
+        user_types, (codes,) = encode_text_columns(trips['User Type'])
+        start_times = trips['Start Time'].to_numpy()
+        heatmaps, first_day, day_counts = user_type_histograms(
+            codes, len(user_types), weekday_hours(trips), start_times.astype('datetime64[D]').astype('int64'))
+
+        quantiles = {}
+        for code, user_type in enumerate(user_types.tolist()):
+            selected = durations[codes == code]
+            if len(selected):
+                quantiles[user_type] = duration_summary(selection_quantiles(selected, DURATION_QUANTILES),
+                                                        len(selected))
+
+        series = {'heatmap': weekday_hour_counts(cube, month_filter, day_filter).tolist(),
+                  'daily_trips': daily_trip_counts(start_times),
+                  'user_types': {user_type: {'heatmap': heatmaps[code].tolist(),
+                                             'daily_trips': day_count_pairs(first_day, day_counts[code])}
+                                 for code, user_type in enumerate(user_types.tolist()) if heatmaps[code].any()},
+                  'duration_quantiles': quantiles}
+        stage['rows'] = len(trips)
+
+    result_cache.put(key, series)
+    return series
+
+def stream_time_series(chunks, month_filter='All', day_filter='All', accuracy=QUANTILE_ACCURACY):
+    """
+    Compute the time series analytics of time_series in a single pass with bounded memory.
+
+    Trips are counted into weekday x hour and calendar day histograms, for
+    all trips and for each user type, and each user type's durations go into a
+    QuantileSketch, so nothing grows with the number of rows.
+
+    Args:
+    chunks (iterable): Tables in the form returned by read_city_table, e.g. from read_city_chunks.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    accuracy (float): The relative accuracy of the duration quantiles.
+
+    Returns:
+    dict: As returned by time_series. Each user type's quantiles come with
+    its trip count; the quantiles are within `accuracy` of the true values.
+    """
+    heatmap = np.zeros((7, 24), dtype='int64')
+    first_day, day_counts = 0, np.zeros(0, dtype='int64')
+    # Each user type's heatmap, first day and calendar day histogram.
+    breakdown = {}
+    sketches = {}
+
+    for chunk in chunks:
+        chunk = chunk[filter_mask(chunk, month_filter, day_filter)]
+        user_types, (codes,) = encode_text_columns(chunk['User Type'])
+        days = chunk['Start Time'].to_numpy().astype('datetime64[D]').astype('int64')
+        heatmaps, chunk_first_day, chunk_day_counts = user_type_histograms(codes, len(user_types),
+                                                                          weekday_hours(chunk), days)
+        heatmap += heatmaps.sum(axis=0)
+
+        # Calendar days as day numbers, counted into histograms that grow at either end as needed.
+        if len(days):
+            first_day, day_counts = merge_histograms(first_day, day_counts,
+                                                     chunk_first_day, chunk_day_counts.sum(axis=0))
+
+        durations = chunk['Trip Duration'].to_numpy()
+        for code, user_type in enumerate(user_types.tolist()):
+            sketches.setdefault(user_type, QuantileSketch(accuracy)).add(durations[codes == code])
+            user_type_heatmap, user_type_first_day, user_type_day_counts = breakdown.get(
+                user_type, (np.zeros((7, 24), dtype='int64'), 0, np.zeros(0, dtype='int64')))
+            breakdown[user_type] = (user_type_heatmap + heatmaps[code],) + merge_histograms(
+                user_type_first_day, user_type_day_counts, chunk_first_day, chunk_day_counts[code])
+
+    quantiles = {user_type: duration_summary([sketch.quantile(q) for q in DURATION_QUANTILES], sketch.count)
+                 for user_type, sketch in sorted(sketches.items())}
+    user_type_series = {user_type: {'heatmap': user_type_heatmap.tolist(),
+                                    'daily_trips': day_count_pairs(user_type_first_day, user_type_day_counts)}
+                        for user_type, (user_type_heatmap, user_type_first_day, user_type_day_counts)
+                        in sorted(breakdown.items()) if user_type_heatmap.any()}
+
+    return {'heatmap': heatmap.tolist(), 'daily_trips': day_count_pairs(first_day, day_counts),
+            'user_types': user_type_series, 'duration_quantiles': quantiles}
+
+def weekday_hours(table):
+    """
+    Number the weekday and hour of each trip of a table, from 0 (Monday, 0h) to 167 (Sunday, 23h).
+
+    Args:
+    table (DataFrame): A table in the form returned by read_city_table.
+
+    Returns:
+    ndarray: The weekday * 24 + hour of each trip.
+    """
+    return table['day_of_week'].to_numpy().astype('int64') * 24 + table['hour'].to_numpy()
+
+def user_type_histograms(codes, user_type_count, weekday_hours, days):
+    """
+    Count the trips of each user type by weekday and hour, and per calendar day, with one bincount each.
+
+    Args:
+    codes (ndarray): The user type code of each trip, from encode_text_columns.
+    user_type_count (int): The number of user types.
+    weekday_hours (ndarray): The weekday and hour of each trip, from weekday_hours.
+    days (ndarray): The calendar day of each trip, as a day number.
+
+    Returns:
+    tuple: The user_type_count x 7 x 24 trip counts, the first day, and the
+    user_type_count x days counts of each day from the first one.
+    """
+    heatmaps = np.bincount(codes * (7 * 24) + weekday_hours,
+                           minlength=user_type_count * 7 * 24).reshape(user_type_count, 7, 24)
+    if len(days) == 0:
+        return heatmaps, 0, np.zeros((user_type_count, 0), dtype='int64')
+
+    first_day = int(days.min())
+    span = int(days.max()) - first_day + 1
+    day_counts = np.bincount(codes * span + (days - first_day),
+                             minlength=user_type_count * span).reshape(user_type_count, span)
+    return heatmaps, first_day, day_counts
+
+def weekday_hour_counts(cube, month_filter, day_filter):
+    """
+    Count the trips of a filter by weekday and hour, from an aggregate cube.
+
+    Args:
+    cube (dict): A cube returned by build_cube.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+
+    Returns:
+    ndarray: A 7 x 24 array of trip counts, Monday first.
+    """
+    trip_counts = cube['trip_counts']
+    if month_filter != 'All':
+        trip_counts = trip_counts[[MONTH_NAMES.index(month_filter)]]
+    heatmap = trip_counts.sum(axis=0)
+
+    if day_filter != 'All':
+        # Other weekdays have no trips under a day filter.
+        heatmap = np.where((np.arange(7) == DAY_NAMES.index(day_filter))[:, None], heatmap, 0)
+
+    return heatmap
+
+def daily_trip_counts(start_times):
+    """
+    Count trips per calendar day with a histogram of day numbers.
+
+    Args:
+    start_times (ndarray): The trips' start times, as datetime64 values.
+
+    Returns:
+    list: (date, count) pairs, with the date as 'YYYY-MM-DD', in date order,
+    for the days with trips.
+    """
+    days = start_times.astype('datetime64[D]').astype('int64')
+    if len(days) == 0:
+        return []
+
+    first_day = int(days.min())
+    return day_count_pairs(first_day, np.bincount(days - first_day))
+
+def day_count_pairs(first_day, counts):
+    """
+    List the days with trips of a calendar day histogram.
+
+    Args:
+    first_day (int): The day number of counts[0].
+    counts (ndarray): The number of trips of each day from the first one.
+
+    Returns:
+    list: (date, count) pairs, with the date as 'YYYY-MM-DD', in date order,
+    for the days with trips.
+    """
+    return [(str(np.datetime64(first_day + offset, 'D')), int(counts[offset]))
+            for offset in np.flatnonzero(counts).tolist()]
+
+def merge_histograms(first, counts, other_first, other_counts):
+    """
+    Add two histograms of integer bins that may start at different bins.
+
+    Args:
+    first (int): The bin of counts[0].
+    counts (ndarray): The counts of the first histogram; it may be empty.
+    other_first (int): The bin of other_counts[0].
+    other_counts (ndarray): The counts of the second histogram.
+
+    Returns:
+    tuple: The first bin and the counts of the sum, spanning both histograms.
+    """
+    if len(counts) == 0:
+        return other_first, other_counts.astype('int64')
+
+    start = min(first, other_first)
+    merged = np.zeros(max(first + len(counts), other_first + len(other_counts)) - start, dtype='int64')
+    merged[first - start:first - start + len(counts)] += counts
+    merged[other_first - start:other_first - start + len(other_counts)] += other_counts
+    return start, merged
+
+def selection_quantiles(values, quantiles):
+    """
+    Compute exact quantiles by selection rather than a full sort.
+
+    np.partition puts the few order statistics needed in place in linear
+    time. Quantiles are interpolated between them as np.percentile does.
+
+    Args:
+    values (ndarray): The values; NaN values are ignored.
+    quantiles (list): The quantiles wanted, between 0 and 1.
+
+    Returns:
+    list: The quantiles in the same order, or None for each if there are no values.
+    """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return [None] * len(quantiles)
+
+    positions = [(len(values) - 1) * q for q in quantiles]
+    ranks = sorted({int(np.floor(position)) for position in positions}
+                   | {int(np.ceil(position)) for position in positions})
+    selected = np.partition(values, ranks)
+
+    return [float(selected[int(np.floor(position))]
+                  + (position - np.floor(position)) * (selected[int(np.ceil(position))]
+                                                       - selected[int(np.floor(position))]))
+            for position in positions]
+
+def duration_summary(quantiles, trip_count=None):
+    """
+    Label duration quantiles for a report.
+
+    Args:
+    quantiles (list): The values of DURATION_QUANTILES, in order.
+    trip_count (int): The number of trips they were computed from, or None to leave it out.
+
+    Returns:
+    dict: The quantiles keyed 'p50', 'p90', ..., plus 'trips' if trip_count is given.
+    """
+    summary = {f'p{round(q * 100):g}': value for q, value in zip(DURATION_QUANTILES, quantiles)}
+    if trip_count is not None:
+        summary['trips'] = trip_count
+
+    return summary
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream of positive values in a histogram with
+    logarithmic bins.
+
+    Bin i holds the values between gamma^(i-1) and gamma^i, where gamma = (1 +
+    accuracy) / (1 - accuracy), so any quantile is estimated within `accuracy`
+    of its true value (relative to it), and the number of bins only grows
+    with the logarithm of the range of the values. Sketches with the same
+    accuracy merge by adding their histograms.
+    """
+
+    def __init__(self, accuracy=QUANTILE_ACCURACY):
+        """
+        Create an empty sketch.
+
+        Args:
+        accuracy (float): The relative accuracy of the quantiles.
+        """
+        self.accuracy = accuracy
+        self.log_gamma = np.log((1 + accuracy) / (1 - accuracy))
+        self.first_bin = 0
+        self.counts = np.zeros(0, dtype='int64')
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, values):
+        """
+        Add values to the sketch.
+
+        Args:
+        values (ndarray): The values; NaN values are ignored, and values of 0
+        or less are counted as 0.
+        """
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        if len(positive) == 0:
+            return
+
+        bins = np.ceil(np.log(positive) / self.log_gamma).astype('int64')
+        self.first_bin, self.counts = merge_histograms(self.first_bin, self.counts,
+                                                       int(bins.min()), np.bincount(bins - bins.min()))
+
+    def merge(self, other):
+        """
+        Add the values of another sketch.
+
+        Args:
+        other (QuantileSketch): A sketch with the same accuracy.
+        """
+        self.first_bin, self.counts = merge_histograms(self.first_bin, self.counts, other.first_bin, other.counts)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Estimate a quantile.
+
+        Args:
+        q (float): The quantile, between 0 and 1.
+
+        Returns:
+        float: The estimate of the value at rank q * (count - 1), interpolated
+        between the values of the ranks either side as selection_quantiles
+        does, or None if the sketch is empty.
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        lower, upper = self.value_at(int(np.floor(rank))), self.value_at(int(np.ceil(rank)))
+        return float(lower + (rank - np.floor(rank)) * (upper - lower))
+
+    def value_at(self, rank):
+        """
+        Estimate the value of a given rank.
+
+        Args:
+        rank (int): The rank, from 0 (the smallest value) to count - 1.
+
+        Returns:
+        float: The middle of the bin holding that rank, within the sketch's accuracy of the value.
+        """
+        if rank < self.zero_count:
+            return 0.0
+
+        position = int(np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side='right'))
+        gamma = np.exp(self.log_gamma)
+        return 2 * gamma ** (self.first_bin + position) / (gamma + 1)
+
+def compute_statistics(filtered_data):
+    """
+    Compute the statistics of a table of filtered trips with a full scan.
+
+    Args:
+    filtered_data (DataFrame): A table of filtered trips returned by load_data.
+
+    Returns:
+    dict: The statistics, in the form returned by summarize_counts.
+    """
+    return stream_statistics([filtered_data])
+
+def stream_statistics(chunks, month_filter='All', day_filter='All'):
+    """
+    Compute every statistic in a single pass over a sequence of tables.
+
+    The chunks are fed into a fresh TripAnalysis, which only keeps running
+    totals, so memory use does not grow with the number of rows.
+
+    Args:
+    chunks (iterable): Tables in the form returned by read_city_table, e.g. from read_city_chunks.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+
+    Returns:
+    dict: The statistics, in the form returned by summarize_counts.
+    """
+    analysis = TripAnalysis(month_filter=month_filter, day_filter=day_filter)
+    for chunk in chunks:
+        analysis.add(chunk)
+
+    return analysis.statistics()
+
+class TripAnalysis:
+    """
+    Running totals and results for one analysis of a city, month and day.
+
+    A fresh TripAnalysis is created for every query, so nothing is carried over
+    from one restart to the next. All totals live in NumPy arrays: text values
+    (stations, user types, genders) get an integer code the first time they are
+    seen and are counted in arrays indexed by that code.
+    """
+
+    def __init__(self, city=None, month_filter='All', day_filter='All'):
+        """
+        Start an empty analysis.
+
+        Args:
+        city (str): The city to analyze, or None when the trips are supplied directly.
+        month_filter (str): The month to filter by, or 'All' to apply no month filter.
+        day_filter (str): The day to filter by, or 'All' to apply no day filter.
+        """
+        self.city = city
+        self.month_filter = month_filter
+        self.day_filter = day_filter
+
+        # Results of the analysis: the statistics, the filtered trips or just
+        # their row numbers (loaded when first needed) and the number of raw
+        # data batches displayed.
+        self.stats = None
+        self.filtered_data = None
+        self.filtered_rows = None
+        self.raw_data_count = 0
+
+        # Running totals of the time of day counts and trip durations.
+        self.month_counts = np.zeros(12, dtype='int64')
+        self.day_counts = np.zeros(7, dtype='int64')
+        self.hour_counts = np.zeros(24, dtype='int64')
+        self.duration_ms = 0
+
+        # Integer code of each text value seen so far, by kind of value.
+        self.codes = {'station': {}, 'user_type': {}, 'gender': {}}
+
+        # Counts indexed by code ('birth_year' is indexed by the year itself).
+        self.counts = {}
+
+        # Route counts as sorted (start_code << 32 | end_code) keys and their counts.
+        self.route_keys = np.zeros(0, dtype='int64')
+        self.route_counts = np.zeros(0, dtype='int64')
+
+    def add(self, chunk):
+        """
+        Add the trips of a table that match the month and day filters.
+
+        Args:
+        chunk (DataFrame): A table in the form returned by read_city_table.
+        """
+        with profiler.stage('filter', rows=len(chunk)):
+            chunk = chunk[filter_mask(chunk, self.month_filter, self.day_filter)]
+        rows = len(chunk)
+
+        # Time of day counts.
+        with profiler.stage('time stats', rows=rows):
+            self.month_counts += np.bincount(chunk['month'].to_numpy() - 1, minlength=12)
+            self.day_counts += np.bincount(chunk['day_of_week'].to_numpy(), minlength=7)
+            self.hour_counts += np.bincount(chunk['hour'].to_numpy(), minlength=24)
+
+        # Trip durations.
+        with profiler.stage('trip stats', rows=rows):
+            self.duration_ms += int(duration_milliseconds(chunk['Trip Duration']).sum())
+
+        # Station and route counts.
+        with profiler.stage('station stats', rows=rows):
+            start_codes = self.encode('station', chunk['Start Station'])
+            end_codes = self.encode('station', chunk['End Station'])
+            self.add_counts('start', start_codes, len(self.codes['station']))
+            self.add_counts('end', end_codes, len(self.codes['station']))
+            self.add_routes((start_codes << 32) | end_codes)
+
+        # Gender and birth year data (Only available for some cities)
+        if 'Gender' in chunk:
+            with profiler.stage('gender', rows=rows):
+                self.add_counts('gender', self.encode('gender', chunk['Gender']), len(self.codes['gender']))
+
+        # User type counts.
+        with profiler.stage('user type', rows=rows):
+            self.add_counts('user_type', self.encode('user_type', chunk['User Type']),
+                            len(self.codes['user_type']))
+
+        if 'Birth Year' in chunk:
+            with profiler.stage('birth year', rows=rows):
+                birth_years = chunk['Birth Year'].to_numpy()
+                birth_years = birth_years[~np.isnan(birth_years)].astype('int64')
+                self.add_counts('birth_year', birth_years, int(birth_years.max(initial=0)) + 1)
+
+    def encode(self, kind, column):
+        """
+        Translate a text column into this analysis' integer codes, adding new values as needed.
+
+        Args:
+        kind (str): The kind of value ('station', 'user_type' or 'gender').
+        column (Series): The text column.
+
+        Returns:
+        ndarray: The int64 code of each row.
+        """
+        codes = self.codes[kind]
+
+        # Only the distinct values of the column go through the dictionary.
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            local_codes, values = column.cat.codes.to_numpy(), column.cat.categories
+        else:
+            local_codes, values = pd.factorize(column)
+        value_codes = np.array([codes.setdefault(str(value), len(codes)) for value in values], dtype='int64')
+
+        return value_codes[local_codes]
+
+    def add_counts(self, name, codes, size, weights=None):
+        """
+        Count codes into one of the count arrays, growing it if new codes appeared.
+
+        Args:
+        name (str): The name of the count array.
+        codes (ndarray): The codes to count.
+        size (int): The number of codes currently in use (or one more than the largest code).
+        weights (ndarray): How many times each code occurred, or None for once each.
+        """
+        totals = padded(self.counts.get(name, np.zeros(0, dtype='int64')), size)
+        totals += np.bincount(codes, weights=weights, minlength=len(totals)).astype('int64')
+        self.counts[name] = totals
+
+    def add_routes(self, route_keys, route_counts=None):
+        """
+        Merge route keys into the sorted route counts.
+
+        Args:
+        route_keys (ndarray): The route key of each trip, or of each route if route_counts is given.
+        route_counts (ndarray): The number of trips of each route, or None for one trip each.
+        """
+        if route_counts is None:
+            route_counts = np.ones(len(route_keys), dtype='int64')
+
+        keys = np.concatenate([self.route_keys, route_keys])
+        counts = np.concatenate([self.route_counts, route_counts])
+
+        self.route_keys, positions = np.unique(keys, return_inverse=True)
+        self.route_counts = np.bincount(positions, weights=counts, minlength=len(self.route_keys)).astype('int64')
+
+    def sorted_names(self, kind, name):
+        """
+        List the names of one kind of value in alphabetical order, with their counts.
+
+        Args:
+        kind (str): The kind of value ('station', 'user_type' or 'gender').
+        name (str): The name of the count array to reorder.
+
+        Returns:
+        tuple: The sorted names, their counts and the alphabetical rank of each code.
+        """
+        names = np.array(list(self.codes[kind]), dtype=str)
+        order = np.argsort(names, kind='stable')
+        ranks = np.empty(len(names), dtype='int64')
+        ranks[order] = np.arange(len(names))
+
+        counts = padded(self.counts.get(name, np.zeros(0, dtype='int64')), len(names))
+        return names[order], counts[order], ranks
+
+    def statistics(self):
+        """
+        Summarize the running totals.
+
+        Returns:
+        dict: The statistics, in the form returned by summarize_counts.
+        """
+        counts = {
+            'month_counts': self.month_counts,
+            'day_counts': self.day_counts,
+            'hour_counts': self.hour_counts,
+            'duration_ms': self.duration_ms,
+        }
 
-# Initialize lists and counters to store data fields and occurrences for analysis
-trip_duration_list, start_station_list, end_station_list = [], [], []
-gender_list, user_list, birthyear_list = [], [], []
-month_counter, day_counter, hour_counter = Counter(), Counter(), Counter()
+        # Stations get codes in name order, so ties resolve the same way as in the cube.
+        station_names, counts['start_counts'], station_ranks = self.sorted_names('station', 'start')
+        counts['station_names'], counts['end_counts'], _ = self.sorted_names('station', 'end')
 
-# Track the number of raw data entries processed.
-raw_data_count = 0
+        route_keys = (station_ranks[self.route_keys >> 32] * len(station_names)
+                      + station_ranks[self.route_keys & 0xFFFFFFFF])
+        counts['route'] = most_common_route(route_keys, self.route_counts, len(station_names))
 
-def load_data(city, month_filter, day_filter):
+        counts['user_type_names'], counts['user_type_counts'], _ = self.sorted_names('user_type', 'user_type')
+
+        if 'gender' in self.counts:
+            counts['gender_names'], counts['gender_counts'], _ = self.sorted_names('gender', 'gender')
+
+        if 'birth_year' in self.counts:
+            counts['first_birth_year'] = 0
+            counts['birth_year_counts'] = self.counts['birth_year']
+
+        self.stats = summarize_counts(counts)
+        return self.stats
+
+    def trips(self):
+        """
+        Return the trips of the analyzed city matching the filters, loading them on first use.
+
+        Returns:
+        DataFrame: The filtered trips, as returned by load_data.
+        """
+        if self.filtered_data is None:
+            self.filtered_data = load_data(self.city, self.month_filter, self.day_filter)
+
+        return self.filtered_data
+
+    def rows(self):
+        """
+        Return the row numbers of the trips matching the filters, which is all
+        disp_raw_data needs.
+
+        Returns:
+        DataFrame: The filtered trips' index, without any columns, or the
+        filtered trips themselves if they are already loaded.
+        """
+        if self.filtered_data is not None:
+            return self.filtered_data
+
+        if self.filtered_rows is None:
+            self.filtered_rows = TripQuery(self.city, self.month_filter, self.day_filter).select().collect()
+
+        return self.filtered_rows
+
+def padded(array, size):
     """
-    Load and filter the data for a given city and apply month and day filters.
+    Extend an array of counts with zeros up to a given size.
 
     Args:
-    city (str): The city to analyze (options are 'CHICAGO', 'NEW YORK', 'WASHINGTON').
-    month_filter (str): The month to filter by, or 'All' to apply no month filter.
-    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    array (ndarray): The counts.
+    size (int): The size to reach.
 
     Returns:
-    list: A list of filtered data rows based on the given filters.
+    ndarray: The counts followed by zeros, or the array itself if it is already long enough.
     """
-    CITY_DATA = {'CHICAGO': 'chicago.csv',
-                 'NEW YORK': 'new_york_city.csv',
-                 'WASHINGTON': 'washington.csv'}
+    if len(array) >= size:
+        return array
+
+    return np.concatenate([array, np.zeros(size - len(array), dtype=array.dtype)])
 
-    file_path = CITY_DATA[city]
+def summarize_counts(counts):
+    """
+    Turn aggregate counts into the statistics shown to the user.
 
-    # Open and read the CSV file.
-    with open(file_path, 'r') as data:
-        csv_reader = csv.reader(data)
+    Ties are resolved in favour of the earliest month, day or hour and the
+    alphabetically first station, route, or lowest birth year, so that the
+    full scan and the cube always agree.
 
-        # Skip the header row.
-        next(csv_reader)
+    Args:
+    counts (dict): Aggregates built by compute_statistics or cube_statistics.
 
-        # Create a list to store filtered data.
-        filtered_data = []
+    Returns:
+    dict: The statistics. Modes are (value, count) pairs, and the gender and
+    birth year entries are None for cities without that data.
+    """
+    trip_count = int(counts['hour_counts'].sum())
+    stats = {'trip_count': trip_count}
+    if trip_count == 0:
+        return stats
 
-        # Loop through each row in the CSV file.
-        for line in csv_reader:
-            # Extract start time data (at index 1).
-            start_time = line[1]
+    station_names = counts['station_names']
+    start_code, end_code, route_count = counts['route']
 
-            # Convert the time data string to a datetime object.
-            date_time_obj = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
+    stats['month'] = most_common(counts['month_counts'], MONTH_NAMES)
+    stats['day'] = most_common(counts['day_counts'], DAY_NAMES)
+    stats['hour'] = most_common(counts['hour_counts'], [f'{hour:02d}' for hour in range(24)])
+    stats['duration_total'] = counts['duration_ms'] / 1000
+    stats['duration_mean'] = stats['duration_total'] / trip_count
+    stats['start_station'] = most_common(counts['start_counts'], station_names)
+    stats['end_station'] = most_common(counts['end_counts'], station_names)
+    stats['route'] = (str(station_names[start_code]), str(station_names[end_code]), int(route_count))
+    stats['user_types'] = nonzero_counts(counts['user_type_names'], counts['user_type_counts'])
 
-            # Extract month, day, and hour from the datetime object.
-            month = date_time_obj.strftime('%B')
-            day = date_time_obj.strftime('%A')
-            hour = date_time_obj.strftime('%H')
+    stats['genders'] = None
+    if 'gender_counts' in counts:
+        stats['genders'] = nonzero_counts(counts['gender_names'], counts['gender_counts'])
 
-            # Apply month and day filters.
-            if (month_filter == month or month_filter == 'All') and (day_filter == day or day_filter == 'All'):
-                # If both filters match (or are not applied), add the row to filtered_data.
-                filtered_data.append(line)
+    stats['birth_years'] = None
+    if 'birth_year_counts' in counts:
+        year_counts = counts['birth_year_counts']
+        years = np.flatnonzero(year_counts) + counts['first_birth_year']
+        stats['birth_years'] = {'earliest': float(years.min()) if len(years) else np.nan,
+                                'latest': float(years.max()) if len(years) else np.nan,
+                                'most_common': None}
+        if len(years):
+            year, count = most_common(year_counts, None)
+            stats['birth_years']['most_common'] = (float(year + counts['first_birth_year']), count)
 
-    return filtered_data
+    return stats
 
-def calculations(filtered_data):
+def most_common(counts, labels):
     """
-    Perform calculations and generate statistics based on the filtered data.
+    Find the most common value from an array of counts.
 
     Args:
-    filtered_data (list): A list of data points (rows) filtered by month and day.
+    counts (ndarray): Count of each value.
+    labels (list): Label of each value, or None to return the value's index.
 
     Returns:
-    None
+    tuple: The label (or index) of the most common value and its count.
+    """
+    index = int(np.argmax(counts))
+    label = index if labels is None else str(labels[index])
+    return label, int(counts[index])
+
+def nonzero_counts(names, counts):
     """
-    if city_filter == 'CHICAGO' or city_filter == 'NEW YORK':
-        # For cities with full data available.
-        start_time = time.time()  # Start the timer for performance measurement.
+    Pair up names with their counts, leaving out names that never occur.
 
-        for data_point in filtered_data:
-            # Process each data point in the filtered dataset.
+    Args:
+    names (ndarray): The names.
+    counts (ndarray): The count of each name.
 
-            # First index to gather start time data
-            filtered_start_time = data_point[1]
+    Returns:
+    dict: The non-zero counts keyed by name.
+    """
+    return {str(name): int(count) for name, count in zip(names, counts) if count > 0}
 
-            # Third index to gather trip duration data
-            float_trip_duration = float(data_point[3])
-            trip_duration_list.append(float_trip_duration)
+def most_common_route(route_keys, route_counts, station_count):
+    """
+    Find the most popular route from counts of (start, end) station code pairs.
 
-            # Fourth and Fifth index to gather station data
-            start_station_list.append(data_point[4])
-            end_station_list.append(data_point[5])
+    Args:
+    route_keys (ndarray): Routes encoded as start_code * station_count + end_code.
+    route_counts (ndarray): Number of trips for each route key (keys may repeat).
+    station_count (int): Number of distinct station names.
 
-            # Sixth index to gather user data
-            user_list.append(data_point[6])
+    Returns:
+    tuple: The start station code, end station code and trip count of the route.
+    """
+    if len(route_keys) == 0:
+        return 0, 0, 0
 
-            # Seventh index to gather gender data (Only available for these two cities)
-            gender_list.append(data_point[7])
+    # Add up the counts of repeated keys (a route seen in several cube cells).
+    keys, positions = np.unique(route_keys, return_inverse=True)
+    totals = np.bincount(positions, weights=route_counts).astype('int64')
 
-            # Eighth index to gather birthyear data (Only available for these two cities)
-            birthyear_list.append((data_point[8]))
+    best = int(np.argmax(totals))
+    start_code, end_code = divmod(int(keys[best]), station_count)
+    return start_code, end_code, int(totals[best])
 
+def encode_text_columns(*columns):
+    """
+    Encode text columns as integer codes into one shared, sorted list of names.
 
-            # Convert the start time to a datetime object.
-            date_time_obj = datetime.strptime(filtered_start_time, '%Y-%m-%d %H:%M:%S')
+    Args:
+    *columns (Series): The text columns to encode.
 
-            # Extract and count occurrences of month, day, and hour.
-            filtered_month_point = date_time_obj.strftime('%B')
-            filtered_day_point = date_time_obj.strftime('%A')
-            filtered_hour_point = date_time_obj.strftime('%H')
+    Returns:
+    tuple: The array of distinct names and a list with the codes of each column.
+    """
+    # Columns already encoded by encode_stations (or alike) keep their codes.
+    first = columns[0]
+    if (all(isinstance(column.dtype, pd.CategoricalDtype) for column in columns)
+            and all(column.cat.categories.equals(first.cat.categories) for column in columns)
+            and first.cat.categories.is_monotonic_increasing):
+        return (np.asarray(first.cat.categories, dtype=str),
+                [column.cat.codes.to_numpy().astype('int64') for column in columns])
 
-            # Update counters with the extracted month, day, and hour.
-            month_counter[filtered_month_point] += 1
-            day_counter[filtered_day_point] += 1
-            hour_counter[filtered_hour_point] += 1
+    names = np.unique(np.concatenate([np.asarray(pd.unique(column), dtype=str) for column in columns]))
+    codes = [np.asarray(pd.Categorical(column, categories=names).codes, dtype='int64') for column in columns]
+    return names, codes
 
-        # Retrieve the most common month, day, and hour from the counters.
-        most_common_month = month_counter.most_common(1)[0]
-        most_common_day = day_counter.most_common(1)[0]
-        most_common_hour = hour_counter.most_common(1)[0]
+def cell_counts(cells, codes, code_count):
+    """
+    Count the occurrences of each code in each (month, weekday) cell.
 
-        end_time = time.time()  # End the timer for performance measurement.
+    Args:
+    cells (ndarray): The cell of each row, as month_index * 7 + weekday.
+    codes (ndarray): The code of each row.
+    code_count (int): Number of distinct codes.
 
-        # Display the most common times and the time taken to compute them.
-        print(f"Most Popular Start Month: {most_common_month[0]}, Count: {most_common_month[1]}")
-        print(f"Most Popular Start Day: {most_common_day[0]}, Count: {most_common_day[1]}")
-        print(f"Most Popular Start Hour: {most_common_hour[0]}, Count: {most_common_hour[1]}")
-        print(f"Time to process Data: {end_time-start_time:.4f} seconds\n")
+    Returns:
+    ndarray: A 12 x 7 x code_count array of counts.
+    """
+    counts = np.bincount(cells * code_count + codes, minlength=12 * 7 * code_count)
+    return counts.reshape(12, 7, code_count)
 
-        # Perform calculations for trip duration statistics.
-        start_time = time.time()
-        sum_trip_duration = sum(trip_duration_list)
-        average_trip = np.mean(trip_duration_list)
-        end_time = time.time()
-        print(f'Total Trip Duration: {sum_trip_duration}, Count {len(trip_duration_list)}')
-        print(f'Average Trip Duration {average_trip}')
-        print(f"Time to process Trip Data: {end_time-start_time:.4f} seconds\n")
-
-        # Calculate the most popular start and end stations using Pandas.
-        start_time = time.time()
-        start_station_series = pd.Series(start_station_list)
-        start_value_counts = start_station_series.value_counts()
-        popular_start_station = start_value_counts.index[0]
-        start_occurrences = start_value_counts.iloc[0]
-
-        end_station_series = pd.Series(end_station_list)
-        end_value_counts = end_station_series.value_counts()
-        popular_end_station = end_value_counts.index[0]
-        end_occurrences = end_value_counts.iloc[0]
-
-        # Create a DataFrame with both start and end stations to find the most common combinations.
-        stations_df = pd.DataFrame({'start_station': start_station_list, 'end_station': end_station_list})
-        station_combinations = stations_df.value_counts().reset_index(name='count')
-
-        # Extract the most common start and end station combination.
-        most_common_combination = station_combinations.iloc[0]
-        most_common_start_station = most_common_combination['start_station']
-        most_common_end_station = most_common_combination['end_station']
-        combination_occurrences = most_common_combination['count']
-        end_time = time.time()
-
-        print(f'The Most Popular Trip combination begins at: {most_common_start_station}, and ends at: {most_common_end_station}, Count: {combination_occurrences}')
-        print(f'Most Popular Start Station: {popular_start_station}, Count: {start_occurrences}')
-        print(f'Most Popular End Station: {popular_end_station}, Count: {end_occurrences}')
-        print(f'Time to process Station Data: {end_time - start_time:.4f} seconds\n')
-
-        # Calculate gender statistics using Pandas.
-        start_time = time.time()
-        gender_series = pd.Series(gender_list)
-        gender_value_counts = gender_series.value_counts()
-        male_occurrences = gender_value_counts.get("Male", 0)
-        female_occurrences = gender_value_counts.get("Female", 0)
-        end_time = time.time()
-
-        print(f'Gender statistics: \nMale: {male_occurrences} \nFemale: {female_occurrences}')
-        print(f'Time to process Gender Data: {end_time - start_time:.4f} seconds\n')
-
-        # Calculate user type statistics using Pandas.
-        start_time = time.time()
-        user_series = pd.Series(user_list)
-        user_value_counts = user_series.value_counts()
-        user_occurrences_1 = user_value_counts.get("Subscriber", 0)
-        user_occurrences_2 = user_value_counts.get("Customer", 0)
-        user_occurrences_3 = user_value_counts.get("Dependent", 0)
-        end_time = time.time()
-
-        print(f'User statistics: \nSubscriber: {user_occurrences_1} \nCustomer: {user_occurrences_2} \nDependent: {user_occurrences_3}')
-        print(f'Time to process User Data: {end_time - start_time:.4f} seconds\n')
-
-        # Process birth year data and compute statistics.
-        start_time = time.time()
-        birthyear_series = pd.Series(birthyear_list)
-        birthyear_series = pd.to_numeric(birthyear_series, errors='coerce')
-        birthyear_value_counts = birthyear_series.value_counts(dropna=True)
-        earliest_birthday = birthyear_series.min()
-        latest_birthday = birthyear_series.max()
-        end_time = time.time()
-
-        print(f'Earliest birthday: {earliest_birthday}, Latest Birthday: {latest_birthday}')
-
-        # Check for the most common birth year, handling NaN values appropriately.
-        if len(birthyear_value_counts) == 0:
-            print("No valid birth years available.")
-        else:
-            most_common_birthyear = birthyear_value_counts.index[0]
-            birthyear_occurrences = birthyear_value_counts.iloc[0]
-            print(f'Most Common Birthyear: {most_common_birthyear}, Count: {birthyear_occurrences}')
-            print(f'Time to process Birthyear Data: {end_time - start_time:.4f} seconds\n')
+def duration_milliseconds(trip_durations):
+    """
+    Convert trip durations in seconds to whole milliseconds.
 
-    else:
-        # Handle the case for Washington where certain data is not available.
-        start_time = time.time()
+    Integer sums are exact whatever order they are added in, so totals from the
+    cube and from a full scan match to the last digit.
+
+    Args:
+    trip_durations (Series): Trip durations in seconds.
+
+    Returns:
+    ndarray: The durations as int64 milliseconds.
+    """
+    return np.rint(trip_durations.to_numpy() * 1000).astype('int64')
+
+def calculations(filtered_data):
+    """
+    Perform calculations and generate statistics based on the filtered data.
+
+    Args:
+    filtered_data (DataFrame): A table of trips filtered by month and day.
 
-        for data_point in filtered_data:
-            # Process each data point for Washington dataset.
+    Returns:
+    None
+    """
+    start_time = time.perf_counter()  # Start the timer for performance measurement.
+    stats = compute_statistics(filtered_data)
+    end_time = time.perf_counter()  # End the timer for performance measurement.
 
-            # First index to gather start time data
-            filtered_start_time = data_point[1]
+    print_statistics(stats)
+    print(f"Time to process Data: {end_time-start_time:.4f} seconds\n")
 
-            # Third index to gather trip duration data
-            float_trip_duration = float(data_point[3])
-            trip_duration_list.append(float_trip_duration)
+def print_statistics(stats):
+    """
+    Display the statistics computed by compute_statistics or cube_statistics.
 
-            # Fourth and Fifth index to gather station data
-            start_station_list.append(data_point[4])
-            end_station_list.append(data_point[5])
+    Args:
+    stats (dict): The statistics to display.
+    """
+    if stats['trip_count'] == 0:
+        print("No trips match the selected filters.")
+        return
 
-            # Sixth index to gather user data
-            user_list.append(data_point[6])
+    # Display the most common times.
+    print(f"Most Popular Start Month: {stats['month'][0]}, Count: {stats['month'][1]}")
+    print(f"Most Popular Start Day: {stats['day'][0]}, Count: {stats['day'][1]}")
+    print(f"Most Popular Start Hour: {stats['hour'][0]}, Count: {stats['hour'][1]}\n")
 
-            # Convert start time to datetime object and extract month, day, and hour.
-            date_time_obj = datetime.strptime(filtered_start_time, '%Y-%m-%d %H:%M:%S')
+    # Display trip duration statistics.
+    print(f"Total Trip Duration: {stats['duration_total']}, Count {stats['trip_count']}")
+    print(f"Average Trip Duration {stats['duration_mean']}\n")
 
-            filtered_month_point = date_time_obj.strftime('%B')
-            filtered_day_point = date_time_obj.strftime('%A')
-            filtered_hour_point = date_time_obj.strftime('%H')
+    # Display the most popular stations and trip.
+    route_start, route_end, route_count = stats['route']
+    print(f'The Most Popular Trip combination begins at: {route_start}, and ends at: {route_end}, Count: {route_count}')
+    print(f"Most Popular Start Station: {stats['start_station'][0]}, Count: {stats['start_station'][1]}")
+    print(f"Most Popular End Station: {stats['end_station'][0]}, Count: {stats['end_station'][1]}\n")
 
-            # Update counters with extracted month, day, and hour.
-            month_counter[filtered_month_point] += 1
-            day_counter[filtered_day_point] += 1
-            hour_counter[filtered_hour_point] += 1
+    # Display gender statistics (Only available for some cities).
+    if stats['genders'] is not None:
+        genders = stats['genders']
+        print(f"Gender statistics: \nMale: {genders.get('Male', 0)} \nFemale: {genders.get('Female', 0)}\n")
 
-        # Retrieve the most common month, day, and hour from counters.
-        most_common_month = month_counter.most_common(1)[0]
-        most_common_day = day_counter.most_common(1)[0]
-        most_common_hour = hour_counter.most_common(1)[0]
+    # Display user type statistics.
+    user_types = stats['user_types']
+    print(f"User statistics: \nSubscriber: {user_types.get('Subscriber', 0)} "
+          f"\nCustomer: {user_types.get('Customer', 0)} \nDependent: {user_types.get('Dependent', 0)}\n")
 
-        end_time = time.time()
+    # Display birth year statistics (Only available for some cities).
+    if stats['birth_years'] is not None:
+        birth_years = stats['birth_years']
+        print(f"Earliest birthday: {birth_years['earliest']}, Latest Birthday: {birth_years['latest']}")
 
-        # Display the most common times and the time taken to compute them.
-        print(f"Most Popular Start Month: {most_common_month[0]}, Count: {most_common_month[1]}")
-        print(f"Most Popular Start Day: {most_common_day[0]}, Count: {most_common_day[1]}")
-        print(f"Most Popular Start Hour: {most_common_hour[0]}, Count: {most_common_hour[1]}")
-        print(f"Time to process Data: {end_time-start_time:.4f} seconds\n")
+        if birth_years['most_common'] is None:
+            print("No valid birth years available.")
+        else:
+            year, count = birth_years['most_common']
+            print(f'Most Common Birthyear: {year}, Count: {count}\n')
+
+def print_top_k(top):
+    """
+    Display the most popular stations and routes found by top_k.
+
+    Args:
+    top (dict): The lists returned by cube_top_k or stream_top_k.
+    """
+    for kind, title in [('start_stations', 'Start Stations'), ('end_stations', 'End Stations'),
+                        ('routes', 'Trips')]:
+        print(f"Top {len(top[kind])} {title}:")
+        for rank, entry in enumerate(top[kind], 1):
+            # Approximate entries end with the most the count may be overestimated by.
+            names = entry[:2] if kind == 'routes' else entry[:1]
+            count = entry[len(names)]
+            error = f' (+/- {entry[-1]})' if len(entry) > len(names) + 1 and entry[-1] else ''
+            print(f"  {rank}. {' to '.join(names)}, Count: {count}{error}")
+        print()
+
+def print_time_series(series):
+    """
+    Display the time series analytics returned by time_series.
 
-        # Perform calculations for trip duration statistics.
-        start_time = time.time()
-        sum_trip_duration = sum(trip_duration_list)
-        average_trip = np.mean(trip_duration_list)
-        end_time = time.time()
-        print(f'Total Trip Duration: {sum_trip_duration}, Count {len(trip_duration_list)}')
-        print(f'Average Trip Duration {average_trip}')
-        print(f"Time to process Trip Data: {end_time-start_time:.4f} seconds\n")
-
-        # Calculate the most popular start and end stations using Pandas.
-        start_time = time.time()
-        start_station_series = pd.Series(start_station_list)
-        start_value_counts = start_station_series.value_counts()
-        popular_start_station = start_value_counts.index[0]
-        start_occurrences = start_value_counts.iloc[0]
-
-        end_station_series = pd.Series(end_station_list)
-        end_value_counts = end_station_series.value_counts()
-        popular_end_station = end_value_counts.index[0]
-        end_occurrences = end_value_counts.iloc[0]
-
-        # Create a DataFrame with both start and end stations to find the most common combinations.
-        stations_df = pd.DataFrame({'start_station': start_station_list, 'end_station': end_station_list})
-        station_combinations = stations_df.value_counts().reset_index(name='count')
-
-        # Extract the most common start and end station combination.
-        most_common_combination = station_combinations.iloc[0]
-        most_common_start_station = most_common_combination['start_station']
-        most_common_end_station = most_common_combination['end_station']
-        combination_occurrences = most_common_combination['count']
-        end_time = time.time()
-
-        print(f'The Most Popular Trip combination begins at: {most_common_start_station}, and ends at: {most_common_end_station}, Count: {combination_occurrences}')
-        print(f'Most Popular Start Station: {popular_start_station}, Count: {start_occurrences}')
-        print(f'Most Popular End Station: {popular_end_station}, Count: {end_occurrences}')
-        print(f'Time to process Station Data: {end_time - start_time:.4f} seconds\n')
-
-        # Calculate user type statistics using Pandas.
-        start_time = time.time()
-        user_series = pd.Series(user_list)
-        user_value_counts = user_series.value_counts()
-        user_occurrences_1 = user_value_counts.get("Subscriber", 0)
-        user_occurrences_2 = user_value_counts.get("Customer", 0)
-        user_occurrences_3 = user_value_counts.get("Dependent", 0)
-        end_time = time.time()
-
-        print(f'User statistics: \nSubscriber: {user_occurrences_1} \nCustomer: {user_occurrences_2} \nDependent: {user_occurrences_3}')
-        print(f'Time to process User Data: {end_time - start_time:.4f} seconds\n')
+    Args:
+    series (dict): The heatmap, daily trips, their breakdown by user type and duration quantiles.
+    """
+    # One row per weekday, one column per hour, every cell as wide as the largest count.
+    width = max(len(str(max(map(max, series['heatmap'])))), 2)
+    print('Trips by Day and Hour:')
+    print('     ' + ' '.join(f'{hour:>{width}}' for hour in range(24)))
+    for day, counts in zip(DAY_NAMES, series['heatmap']):
+        print(f'{day[:3]:<5}' + ' '.join(f'{count:>{width}}' for count in counts))
+    print()
+
+    daily_trips = series['daily_trips']
+    if daily_trips:
+        busiest = max(daily_trips, key=lambda entry: entry[1])
+        quietest = min(daily_trips, key=lambda entry: entry[1])
+        print(f"Trips per Day: {len(daily_trips)} days from {daily_trips[0][0]} to {daily_trips[-1][0]}")
+        print(f"  Busiest Day: {busiest[0]}, Count: {busiest[1]}")
+        print(f"  Quietest Day: {quietest[0]}, Count: {quietest[1]}")
+        print()
+
+    print('Busiest Times by User Type:')
+    for user_type, user_type_series in series['user_types'].items():
+        counts = np.array(user_type_series['heatmap'])
+        day, hour = np.unravel_index(int(counts.argmax()), counts.shape)
+        busiest = max(user_type_series['daily_trips'], key=lambda entry: entry[1])
+        print(f"  {user_type or 'Unknown'}: {DAY_NAMES[day]} at {hour}:00 ({counts[day, hour]} trips), "
+              f"busiest day {busiest[0]} ({busiest[1]} trips)")
+    print()
 
+    print('Trip Duration Quantiles by User Type (seconds):')
+    for user_type, summary in series['duration_quantiles'].items():
+        quantiles = ', '.join(f'{name}: {value:.0f}' for name, value in summary.items() if name != 'trips')
+        print(f"  {user_type or 'Unknown'}: {quantiles} ({summary['trips']} trips)")
+    print()
 
 def get_filter():
     """
@@ -428,86 +3447,577 @@ def get_filter():
             print("Invalid filter. Please choose month, day, both, or none.")
 
 
-def disp_raw_data(filtered_data, raw_data_count, batch_size=5):
+def disp_raw_data(city, filtered_data, raw_data_count, batch_size=5, page=None):
     """
     Display raw data in batches of 5 based on user request.
 
+    Rows are read straight from the city file using its row index, so showing
+    a batch costs one seek and read per row, whatever the size of the file.
+
     Args:
-    filtered_data (list): List of filtered data based on user input.
-    raw_data_count (int): The current count of displayed raw data batches.
+    city (str): The city the data belongs to.
+    filtered_data (DataFrame): Table of filtered data based on user input.
+    raw_data_count (int): The number of the next batch to display, counting from 0.
     batch_size (int): The number of data points to display in each batch. Default is 5
+    page (int): The batch to display instead of the next one, counting from 0. Default is None
 
     Returns:
-    int: Updated raw_data_count after displaying a batch of raw data.
+    int: Updated raw_data_count after displaying a batch of raw data, unchanged when
+         the requested batch is past the end of the data.
     """
-    CITY_DATA = {'CHICAGO': 'chicago.csv',
-                 'NEW YORK': 'new_york_city.csv',
-                 'WASHINGTON': 'washington.csv'}
+    if page is None:
+        page = raw_data_count
+
+    # Calculate the start and end index for the current batch
+    start_index = page * batch_size
+    end_index = start_index + batch_size
 
-    file_path = CITY_DATA[city_filter]
+    # Find where the rows of the current batch are in the file
+    row_numbers = filtered_data.index[start_index:end_index]
+    if len(row_numbers) == 0:
+        print("There is no more trip data to display.")
+        return raw_data_count
 
-    # Open and read the CSV file
-    with open(file_path, 'r') as data:
-        csv_reader = csv.reader(data)
+    header, rows = read_raw_rows(CITY_DATA[city], row_numbers)
 
-        # Convert the csv_reader to a list
-        data_list = list(csv_reader)
+    # Display data in the current batch
+    print(header)
+    display_batch(rows)
 
-        # Now you can access specific rows using indexing
-        print(data_list[0])  # Print the first row (header)
+    # The batch after this one is the next to display
+    return page + 1
 
-        # Calculate the start and end index for the current batch
-        start_index = raw_data_count * batch_size
-        end_index = start_index + batch_size
+def display_batch(rows):
+    """
+        Helper function to display a batch of data.
 
+        Args:
+            rows (list): The raw rows to display, each a list of field values.
+        """
+    for row in rows:
+        print(row)
 
-        # Display data in the current batch
-        display_batch(filtered_data, start_index, end_index)
+def read_raw_rows(file_path, row_numbers):
+    """
+    Read rows of a city file by their row number, using the file's row index.
 
-        # Increment count for next batch
-        raw_data_count += 1
-        return raw_data_count
+    Args:
+    file_path (str): Path of the city CSV file.
+    row_numbers (list): Row numbers (0 for the first trip) of the rows to read.
 
-def display_batch(filtered_data,start_index, end_index):
+    Returns:
+    tuple: The header row and the requested rows, each a list of field values.
     """
-        Helper function to display a batch of data.
+    header, row_offsets = load_row_index(file_path)
+
+    lines = []
+    with open(file_path, 'rb') as data:
+        for row_number in row_numbers:
+            data.seek(row_offsets[row_number])
+            line = data.read(row_offsets[row_number + 1] - row_offsets[row_number]).decode()
+            lines.append(line.rstrip('\r\n'))
+
+    return header, list(csv.reader(lines))
+
+# Row indexes already loaded, by file path, as (file signature, header, row offsets).
+row_indexes = {}
+
+def load_row_index(file_path):
+    """
+    Load the row index of a city file, using the on-disk cache when it is current.
+
+    An index is read from disk once and kept in memory while the file is
+    unchanged, so paging through trips costs the same whatever the file's size.
+
+    Args:
+    file_path (str): Path of the city CSV file.
+
+    Returns:
+    tuple: The header row (a list of field values) and the row offsets from build_row_index.
+    """
+    signature = file_signature(file_path)
+    if file_path in row_indexes and np.array_equal(row_indexes[file_path][0], signature):
+        return row_indexes[file_path][1:]
+
+    cache_path = cache_file_path(file_path, 'rows')
+    cache = read_cache_file(cache_path, signature)
+    if cache is None:
+        cache = build_row_index(file_path)
+        write_cache_file(cache_path, cache, signature)
+
+    row_indexes[file_path] = (signature, cache['header'].tolist(), cache['row_offsets'])
+    return row_indexes[file_path][1:]
+
+def build_row_index(file_path):
+    """
+    Find the byte offset at which each row of a city file starts.
+
+    The file is scanned for line breaks in large binary blocks. Like pandas,
+    blank lines are skipped, so row numbers match the index of the tables
+    returned by read_city_table (the files hold one trip per line).
+
+    Args:
+    file_path (str): Path of the city CSV file.
+
+    Returns:
+    dict: The 'header' row as an array of field values, and the 'row_offsets'
+    array, where row i runs from row_offsets[i] to row_offsets[i + 1].
+    """
+    line_starts = [np.zeros(1, dtype='int64')]
+    position = 0
+
+    with open(file_path, 'rb') as data:
+        while True:
+            block = data.read(INDEX_BLOCK_SIZE)
+            if not block:
+                break
+
+            # Every line break starts a new line at the next byte.
+            line_breaks = np.flatnonzero(np.frombuffer(block, dtype='uint8') == ord('\n'))
+            line_starts.append(line_breaks + position + 1)
+            position += len(block)
+
+        data.seek(0)
+        header = next(csv.reader([data.readline().decode()]))
+
+    # Line i runs from line_starts[i] to line_starts[i + 1]. Skip the header and
+    # blank lines (at most a line break), including the empty 'line' after a
+    # final line break.
+    line_starts = np.unique(np.concatenate(line_starts + [np.array([position], dtype='int64')]))
+    is_row = np.diff(line_starts) > 2
+    is_row[:1] = False
+
+    # Row i ends where row i + 1 starts (give or take blank lines), so only the
+    # start of each row and the end of the last one are stored.
+    row_offsets = line_starts[:-1][is_row]
+    last_end = line_starts[1:][is_row][-1:] if is_row.any() else line_starts[-1:]
+    row_offsets = np.append(row_offsets, last_end)
+
+    return {'header': np.array(header, dtype=str), 'row_offsets': row_offsets}
+
+def query_report(city, month_filter, day_filter, top=0, series=False, approximate=False):
+    """
+    Answer a single query given on the command line, without prompting.
+
+    Args:
+    city (str): The city to analyze.
+    month_filter (str): The month to filter by, or 'All' to apply no month filter.
+    day_filter (str): The day to filter by, or 'All' to apply no day filter.
+    top (int): The number of most popular stations and routes to add, or 0 for none.
+    series (bool): Add the time series analytics of time_series.
+    approximate (bool): Estimate those in one bounded-memory pass over the CSV file.
+
+    Returns:
+    list: The single row from flatten_statistics, with the 'top' lists and
+    'time_series' added when asked for (JSON reports only).
+    """
+    row = flatten_statistics(city, month_filter, day_filter, filter_statistics(city, month_filter, day_filter))
+    if top > 0:
+        row['top'] = top_k(city, month_filter, day_filter, top, approximate)
+    if series:
+        row['time_series'] = time_series(city, month_filter, day_filter, approximate)
+
+    return [row]
+
+def batch_report(cities=None, workers=None):
+    """
+    Compute the statistics of every city under every month/day filter combination.
+
+    Each city is handled by its own worker process, which reads the city's data
+    once (through its aggregate cube) and answers every combination from it.
+
+    Args:
+    cities (list): The cities to report on, or None for every city in CITY_DATA.
+    workers (int): The number of worker processes, or None for one per city.
+
+    Returns:
+    list: One row per city and filter combination, from flatten_statistics.
+    """
+    cities = list(CITY_DATA) if cities is None else cities
+
+    with futures.ProcessPoolExecutor(max_workers=workers or len(cities)) as pool:
+        city_reports = list(pool.map(city_report, cities, [profiler.level] * len(cities)))
+
+    # Collect the stages profiled in the worker processes.
+    for _, records in city_reports:
+        profiler.records.extend(records)
+
+    return [row for rows, _ in city_reports for row in rows]
+
+def city_report(city, profile_level='off'):
+    """
+    Compute the statistics of one city under every month/day filter combination.
+
+    Args:
+    city (str): The city to report on.
+    profile_level (str): The level at which to profile the work, one of PROFILE_LEVELS.
+
+    Returns:
+    tuple: One row per filter combination, from flatten_statistics, and the
+    profiler records of the work.
+    """
+    profiler.set_level(profile_level)
+    profiler.reset()
+
+    with profiler.stage('cube load'):
+        cube = load_city_cube(CITY_DATA[city])
+
+    rows = []
+    with profiler.stage('cube query') as stage:
+        for month_filter in ['All'] + FILTER_MONTHS:
+            for day_filter in ['All'] + DAY_NAMES:
+                stats = cube_statistics(cube, month_filter, day_filter)
+                rows.append(flatten_statistics(city, month_filter, day_filter, stats))
+                stage['rows'] += stats['trip_count']
+
+    return rows, profiler.records
+
+def flatten_statistics(city, month_filter, day_filter, stats):
+    """
+    Lay out statistics as a flat record, for JSON or CSV reports.
+
+    Args:
+    city (str): The city the statistics are for.
+    month_filter (str): The month filter applied.
+    day_filter (str): The day filter applied.
+    stats (dict): The statistics, as returned by summarize_counts.
+
+    Returns:
+    dict: The record, with None for values that are not available.
+    """
+    row = dict.fromkeys(REPORT_FIELDS)
+    row.update({'city': city, 'month_filter': month_filter, 'day_filter': day_filter,
+                'trip_count': stats['trip_count']})
+    if stats['trip_count'] == 0:
+        return row
+
+    row['popular_month'], row['popular_month_count'] = stats['month']
+    row['popular_day'], row['popular_day_count'] = stats['day']
+    row['popular_hour'], row['popular_hour_count'] = stats['hour']
+    row['total_duration'] = stats['duration_total']
+    row['average_duration'] = stats['duration_mean']
+    row['popular_start_station'], row['popular_start_station_count'] = stats['start_station']
+    row['popular_end_station'], row['popular_end_station_count'] = stats['end_station']
+    row['popular_route_start'], row['popular_route_end'], row['popular_route_count'] = stats['route']
+    row['subscribers'] = stats['user_types'].get('Subscriber', 0)
+    row['customers'] = stats['user_types'].get('Customer', 0)
+    row['dependents'] = stats['user_types'].get('Dependent', 0)
+
+    if stats['genders'] is not None:
+        row['male'] = stats['genders'].get('Male', 0)
+        row['female'] = stats['genders'].get('Female', 0)
+
+    if stats['birth_years'] is not None and stats['birth_years']['most_common'] is not None:
+        row['earliest_birth_year'] = stats['birth_years']['earliest']
+        row['latest_birth_year'] = stats['birth_years']['latest']
+        row['popular_birth_year'], row['popular_birth_year_count'] = stats['birth_years']['most_common']
+
+    return row
+
+def write_report(rows, output, report_format):
+    """
+    Write report records as JSON or CSV.
+
+    Args:
+    rows (list): The records, from flatten_statistics.
+    output (file): The file to write to.
+    report_format (str): 'json' or 'csv'.
+    """
+    if report_format == 'json':
+        json.dump(rows, output, indent=2)
+        output.write('\n')
+    else:
+        # Only the statistics fit in CSV columns; lists added by query_report are left out.
+        writer = csv.DictWriter(output, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+class QueryServer:
+    """
+    Answer month/day filter queries over HTTP from aggregate cubes kept in memory.
+
+    Every city's cube is loaded once, when the server starts, and reloaded only
+    when its CSV file changes, so a query costs a few array sums instead of a
+    file read. Queries are small enough to be answered directly on the event
+    loop, which lets a single process serve many concurrent clients. Reloads
+    and time series queries are the exception: they read the city file, so
+    they run on a worker thread while the loop serves other clients.
+
+    Requests look like GET /stats?city=chicago&month=march&day=monday (month and
+    day default to All) and are answered with the JSON record built by
+    flatten_statistics. GET /top takes the same parameters, plus k, and answers
+    with the lists of the most popular stations and routes from cube_top_k.
+    GET /timeseries takes the same parameters as /stats and answers with the
+    heatmap, daily trips (both in total and per user type) and duration quantiles from time_series. GET /health
+    reports the cities loaded and the use of the result cache.
+    """
+
+    def __init__(self):
+        """
+        Load the cube of every city.
+        """
+        self.cubes = {}
+        self.reloads = {}
+        for city in CITY_DATA:
+            self.cubes[city] = self.load_cube(city)
+
+    def load_cube(self, city):
+        """
+        Load a city's cube, with the signature of the file it was loaded from.
+
+        Args:
+        city (str): The city.
+
+        Returns:
+        tuple: The signature from file_signature and the cube returned by build_cube.
+        """
+        signature = file_signature(CITY_DATA[city])
+        return signature, load_city_cube(CITY_DATA[city])
+
+    async def cube(self, city, wait=False):
+        """
+        Return a city's cube, reloading it on a worker thread if the city file has changed since it was loaded.
+
+        Only one reload of a city runs at a time. Until it finishes, queries
+        that do not wait for it are answered from the cube already loaded.
+
+        Args:
+        city (str): The city.
+        wait (bool): Wait for the reload, rather than return the cube already loaded.
+
+        Returns:
+        tuple: The cube returned by build_cube, and whether it is up to date with the city file.
+        """
+        signature, cube = self.cubes[city]
+        if np.array_equal(signature, file_signature(CITY_DATA[city])):
+            return cube, True
+
+        if city not in self.reloads:
+            reload = asyncio.get_running_loop().run_in_executor(None, self.load_cube, city)
+            reload.add_done_callback(lambda reload: self.reloaded(city, reload))
+            self.reloads[city] = reload
+        if not wait:
+            return cube, False
+
+        # Shielded, so a client that goes away does not cancel the reload for the others.
+        return (await asyncio.shield(self.reloads[city]))[1], True
+
+    def reloaded(self, city, reload):
+        """
+        Replace a city's cube once its reload has finished.
+
+        A reload that failed keeps the cube already loaded; the next query
+        starts another one.
+
+        Args:
+        city (str): The city.
+        reload (Future): The reload, which returns the result of load_cube.
+        """
+        del self.reloads[city]
+        if not reload.cancelled() and reload.exception() is None:
+            self.cubes[city] = reload.result()
+
+    async def query(self, path, parameters):
+        """
+        Answer a statistics, top-K or time series query.
+
+        Args:
+        path (str): '/stats', '/top' or '/timeseries'.
+        parameters (dict): The query string parameters: city, and optionally month, day and (for /top) k.
+
+        Returns:
+        tuple: The HTTP status and the JSON-serializable body.
+        """
+        city = parameters.get('city', '').upper().replace('_', ' ')
+        month_filter = parameters.get('month', 'All').title()
+        day_filter = parameters.get('day', 'All').title()
+
+        if city not in CITY_DATA:
+            return 400, {'error': f"Unknown city '{parameters.get('city', '')}'. "
+                                  f"Choose one of: {', '.join(CITY_DATA)}."}
+        if month_filter not in ['All'] + MONTH_NAMES:
+            return 400, {'error': f"Unknown month '{parameters['month']}'."}
+        if day_filter not in ['All'] + DAY_NAMES:
+            return 400, {'error': f"Unknown day '{parameters['day']}'."}
+
+        if path == '/top':
+            if not parameters.get('k', str(TOP_K)).isdigit():
+                return 400, {'error': f"k must be a whole number, not '{parameters['k']}'."}
+            cube, _ = await self.cube(city)
+            top = cube_top_k(cube, month_filter, day_filter, int(parameters.get('k', TOP_K)))
+            return 200, dict(top, city=city, month_filter=month_filter, day_filter=day_filter)
+
+        if path == '/timeseries':
+            # The trips are read from the current file, so the heatmap must come from its cube too.
+            cube, _ = await self.cube(city, wait=True)
+            series = await asyncio.get_running_loop().run_in_executor(
+                None, time_series, city, month_filter, day_filter, False, cube)
+            return 200, dict(series, city=city, month_filter=month_filter, day_filter=day_filter)
+
+        cube, current = await self.cube(city)
+        if current:
+            stats = filter_statistics(city, month_filter, day_filter, cube)
+        else:
+            # The result cache is keyed by the current file, so answers from the old cube are not kept.
+            stats = cube_statistics(cube, month_filter, day_filter)
+        return 200, flatten_statistics(city, month_filter, day_filter, stats)
+
+    async def respond(self, method, target):
+        """
+        Route an HTTP request.
+
+        Args:
+        method (str): The request method.
+        target (str): The request target (path and query string).
+
+        Returns:
+        tuple: The HTTP status and the JSON-serializable body.
+        """
+        url = urlsplit(target)
+        if url.path not in ['/stats', '/top', '/timeseries', '/health']:
+            return 404, {'error': f"No such path '{url.path}'. Use /stats, /top, /timeseries or /health."}
+        if method != 'GET':
+            return 405, {'error': 'Only GET requests are supported.'}
+        if url.path == '/health':
+            return 200, {'status': 'ok', 'cities': list(self.cubes), 'result_cache': result_cache.summary()}
+
+        return await self.query(url.path, dict(parse_qsl(url.query)))
+
+    async def handle_client(self, reader, writer):
+        """
+        Serve the requests of one client connection, keeping it open between requests.
 
         Args:
-            filtered_data (list): List of filtered data based on user input.
-            start_index (int): The starting index of the batch.
-            end_index (int): The ending index of the batch.
+        reader (StreamReader): The connection's input stream.
+        writer (StreamWriter): The connection's output stream.
         """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
 
-    for i in range(start_index, min(end_index, len(filtered_data))):
-        print(filtered_data[i])
+                # Only the Connection header matters; request bodies are not used.
+                keep_alive = not request_line.rstrip().endswith(b'HTTP/1.0')
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'connection':
+                        keep_alive = value.strip().lower() == 'keep-alive'
 
+                try:
+                    method, target, _ = request_line.decode('latin-1').split()
+                except ValueError:
+                    method = target = None
+
+                if method is None:
+                    status, body = 400, {'error': 'Malformed request line.'}
+                    keep_alive = False
+                else:
+                    try:
+                        status, body = await self.respond(method, target)
+                    except Exception as error:
+                        # E.g. a city file that went missing or no longer parses; the server keeps running.
+                        status, body = 500, {'error': f'{type(error).__name__}: {error}'}
+
+                payload = json.dumps(body).encode()
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVER_HOST, port=SERVER_PORT, socket_path=None):
+        """
+        Listen for clients until the process is stopped.
+
+        Args:
+        host (str): The address to listen on.
+        port (int): The TCP port to listen on.
+        socket_path (str): A Unix socket to listen on instead of a TCP port, or None.
+        """
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_client, socket_path)
+            print(f'Serving bikeshare statistics on {socket_path}')
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+            print(f'Serving bikeshare statistics on http://{host}:{port}/stats')
 
+        async with server:
+            await server.serve_forever()
 
-def main():
+def main(profile_output=None, top=0, approximate=False, series=False):
     """
     Main function to run the interactive bikeshare data analysis program.
+
+    Args:
+    profile_output (str): File to save the profile of each query to as JSON, or None.
+    top (int): The number of most popular stations and routes to list after the statistics, or 0 for none.
+    approximate (bool): Estimate those stations and routes, and the time series quantiles, in one
+    bounded-memory pass over the CSV file.
+    series (bool): Also show the trips by day and hour, per calendar day, and the trip duration quantiles.
     """
-    while True:
-        global city_filter, month_filter, day_filter, raw_data_count
+    # Import the heavy modules while the user answers the prompts, rather than after.
+    for name in ['numpy', 'pandas']:
+        threading.Thread(target=importlib.import_module, args=(name,), daemon=True).start()
 
+    while True:
         # Get filters from the user
-        city_filter, month_filter, day_filter = get_filter()
+        city, month_filter, day_filter = get_filter()
+
+        # Start a fresh analysis (and profile) for this query, so nothing carries over from earlier ones
+        analysis = TripAnalysis(city, month_filter, day_filter)
+        profiler.reset()
+
+        # Answer the query from the city's precomputed aggregate cube, or from an earlier identical query
+        start_time = time.perf_counter()
+        analysis.stats = filter_statistics(city, month_filter, day_filter)
+        end_time = time.perf_counter()
+
+        print_statistics(analysis.stats)
+        print(f"Time to process Data: {end_time-start_time:.4f} seconds\n")
 
-        # Load data based on filters
-        filtered_data = load_data(city_filter, month_filter, day_filter)
+        if top > 0:
+            with profiler.stage('top k'):
+                print_top_k(top_k(city, month_filter, day_filter, top, approximate))
+        if series:
+            print_time_series(time_series(city, month_filter, day_filter, approximate))
 
-        # Perform calculations on the filtered data
-        calculations(filtered_data)
+        profiler.report()
+        if profiler.level != 'off':
+            print('Result cache: {hits} hits, {misses} misses, {evictions} evictions, '
+                  '{entries} results held ({mb} MB)\n'.format(**result_cache.summary()))
+        if profile_output:
+            profiler.write_json(profile_output)
 
         # Ask the user if they want to view individual trip data
         while True:
-            raw_data_input = input('Would you like to view individual trip data? Enter yes or no. ').upper().strip()
+            raw_data_input = input('Would you like to view individual trip data? '
+                                   'Enter yes, back, a page number, or no. ').upper().strip()
             if raw_data_input == 'YES':
-                raw_data_count = disp_raw_data(filtered_data, raw_data_count)  # Update raw_data_count
+                # The matching row numbers are only loaded the first time the user asks to see the trips
+                analysis.raw_data_count = disp_raw_data(city, analysis.rows(), analysis.raw_data_count)
+            elif raw_data_input == 'BACK':
+                # Go back to the batch before the one last displayed
+                analysis.raw_data_count = disp_raw_data(city, analysis.rows(), analysis.raw_data_count,
+                                                        page=max(analysis.raw_data_count - 2, 0))
+            elif raw_data_input.isdigit() and int(raw_data_input) > 0:
+                # Jump to the requested batch (1 is the first)
+                analysis.raw_data_count = disp_raw_data(city, analysis.rows(), analysis.raw_data_count,
+                                                        page=int(raw_data_input) - 1)
             elif raw_data_input == 'NO':
                 break
             else:
-                print("Invalid input. Please choose yes or no.")
+                print("Invalid input. Please choose yes, back, a page number, or no.")
 
         # Ask the user if they want to restart the analysis
         while True:
@@ -521,5 +4031,80 @@ def main():
 
 
 
+def parse_arguments():
+    """
+    Parse the command line options.
+
+    Returns:
+    Namespace: The options. Without --batch, --city or --serve the program runs interactively.
+    """
+    parser = argparse.ArgumentParser(description='Explore US bikeshare data.')
+    parser.add_argument('--batch', action='store_true',
+                        help='report on every city and month/day filter instead of asking')
+    parser.add_argument('--city', type=lambda city: city.upper().replace('_', ' '), choices=list(CITY_DATA),
+                        help='report on this city instead of asking, e.g. chicago or new_york')
+    parser.add_argument('--month', type=str.title, choices=['All'] + MONTH_NAMES, default='All',
+                        help='month filter of --city (default: All)')
+    parser.add_argument('--day', type=str.title, choices=['All'] + DAY_NAMES, default='All',
+                        help='day filter of --city (default: All)')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json',
+                        help='format of the --batch or --city report (default: json)')
+    parser.add_argument('--output', help='file to write the --batch or --city report to (default: standard output)')
+    parser.add_argument('--workers', type=int, help='number of worker processes for the batch report')
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                        help='processes parsing a city file in parallel when its cache must be built, '
+                             f'0 for one per CPU (default: {PARSE_WORKERS})')
+    parser.add_argument('--profile', choices=PROFILE_LEVELS, default='off',
+                        help='report the time and memory used by each stage (default: off)')
+    parser.add_argument('--profile-output', help='file to save the stage profile to as JSON')
+    parser.add_argument('--cache-entries', type=int, default=RESULT_CACHE_ENTRIES,
+                        help=f'query results kept in memory, 0 to keep none (default: {RESULT_CACHE_ENTRIES})')
+    parser.add_argument('--cache-mb', type=float, default=RESULT_CACHE_MB,
+                        help=f'memory the kept query results may use, in MB (default: {RESULT_CACHE_MB})')
+    parser.add_argument('--top', type=int, default=0,
+                        help='also list the K most popular stations and trips of each query (default: 0, none)')
+    parser.add_argument('--approximate', action='store_true',
+                        help='estimate the --top lists and --time-series quantiles in one bounded-memory '
+                             'pass over the CSV file')
+    parser.add_argument('--time-series', action='store_true',
+                        help='also show trips by day and hour, trips per day and trip duration quantiles')
+    parser.add_argument('--serve', action='store_true',
+                        help='answer queries over HTTP from a long-running server instead of asking')
+    parser.add_argument('--host', default=SERVER_HOST, help=f'address the server listens on (default: {SERVER_HOST})')
+    parser.add_argument('--port', type=int, default=SERVER_PORT,
+                        help=f'port the server listens on (default: {SERVER_PORT})')
+    parser.add_argument('--socket', help='Unix socket the server listens on instead of a TCP port')
+    arguments = parser.parse_args()
+
+    if arguments.city is None and (arguments.month != 'All' or arguments.day != 'All'):
+        parser.error('--month and --day filter a --city report')
+    return arguments
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    arguments = parse_arguments()
+    profiler.set_level(arguments.profile)
+    result_cache.configure(arguments.cache_entries, arguments.cache_mb)
+    PARSE_WORKERS = arguments.parse_workers
+
+    if arguments.batch or arguments.city:
+        if arguments.batch:
+            report = batch_report(workers=arguments.workers)
+        else:
+            report = query_report(arguments.city, arguments.month, arguments.day, arguments.top,
+                                  arguments.time_series, arguments.approximate)
+        if arguments.output:
+            with open(arguments.output, 'w', newline='') as report_file:
+                write_report(report, report_file, arguments.format)
+        else:
+            write_report(report, sys.stdout, arguments.format)
+
+        # Keep the profile off standard output, which may hold the report.
+        if arguments.profile_output:
+            profiler.write_json(arguments.profile_output)
+    elif arguments.serve:
+        try:
+            asyncio.run(QueryServer().serve(arguments.host, arguments.port, arguments.socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        main(arguments.profile_output, arguments.top, arguments.approximate, arguments.time_series)
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# bikeshare.py is a script at the root of the repository rather than an installed package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,125 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import bikeshare
+
+HEADER = ',Start Time,End Time,Trip Duration,Start Station,End Station,User Type,Gender,Birth Year\n'
+
+FILTERS = [(month, day) for month in ['All'] + bikeshare.FILTER_MONTHS for day in ['All'] + bikeshare.DAY_NAMES]
+
+
+def city_rows(count, seed):
+    """
+    Make rows of a city file, spread over the first half of 2017.
+
+    Args:
+    count (int): The number of rows.
+    seed (int): Seed of the random values.
+
+    Returns:
+    list: The rows as CSV lines, with their line breaks.
+    """
+    generator = random.Random(seed)
+    rows = []
+    for row in range(count):
+        month, day = generator.randint(1, 6), generator.randint(1, 28)
+        hour, minute = generator.randint(0, 23), generator.randint(0, 59)
+        start = f'2017-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:00'
+        end = f'2017-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:30'
+        user_type = generator.choice(['Subscriber', 'Customer', ''])
+        gender = generator.choice(['Male', 'Female', ''])
+        birth_year = generator.choice(['1980.0', '1991.0', ''])
+        rows.append(f'{seed * 100000 + row},{start},{end},{generator.randint(60, 3600)},'
+                    f'Station {generator.randint(1, 30)},Station {generator.randint(1, 30)},'
+                    f'{user_type},{gender},{birth_year}\n')
+
+    return rows
+
+
+def write_city_file(file_path, rows):
+    with open(file_path, 'w', newline='') as city_file:
+        city_file.write(HEADER + ''.join(rows))
+
+    # Make sure the file's signature changes, however coarse the file system's clock.
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def fresh_cube(file_path):
+    return bikeshare.build_cube(bikeshare.read_city_table(str(file_path)))
+
+
+def assert_same_cube(cube, expected):
+    assert cube.keys() == expected.keys()
+    for name in expected:
+        assert np.array_equal(cube[name], expected[name]), name
+
+
+@pytest.fixture
+def city_file(tmp_path):
+    bikeshare.result_cache.clear()
+    file_path = tmp_path / 'city.csv'
+    write_city_file(file_path, city_rows(3000, 1))
+    return file_path
+
+
+def test_appended_rows_give_the_fresh_cube_for_every_filter(city_file):
+    rows = city_rows(3000, 1)
+    bikeshare.load_city_cube(str(city_file))
+    bikeshare.load_city_table(str(city_file))
+
+    # Appended rows bring new stations and user types' counts.
+    rows += city_rows(500, 2) + ['9999999,2017-06-30 23:59:59,2017-07-01 00:10:00,660,New Station,Station 1,'
+                                 'Dependent,Female,1975.0\n']
+    write_city_file(city_file, rows)
+    assert bikeshare.appended_range(str(city_file), bikeshare.read_cache_file(
+        bikeshare.cache_file_path(str(city_file), 'cube'), None)) is not None
+
+    cube = bikeshare.load_city_cube(str(city_file))
+    expected = fresh_cube(city_file)
+    assert_same_cube(cube, expected)
+    for month_filter, day_filter in FILTERS:
+        assert (bikeshare.cube_statistics(cube, month_filter, day_filter)
+                == bikeshare.cube_statistics(expected, month_filter, day_filter)), (month_filter, day_filter)
+
+    table = bikeshare.load_city_table(str(city_file))
+    fresh_table = bikeshare.read_city_table(str(city_file))
+    assert (table.dtypes == fresh_table.dtypes).all()
+    assert table.equals(fresh_table)
+
+
+def test_same_size_edit_rebuilds_the_caches(city_file):
+    bikeshare.load_city_cube(str(city_file))
+    bikeshare.load_city_table(str(city_file))
+
+    # Rewrite one user type in the middle of the file, keeping its size.
+    data = city_file.read_bytes()
+    position = data.index(b'Subscriber', len(data) // 2)
+    city_file.write_bytes(data[:position] + b'Customerzz' + data[position + len(b'Subscriber'):])
+    stat = os.stat(city_file)
+    os.utime(city_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert os.path.getsize(city_file) == len(data)
+
+    cache = bikeshare.read_cache_file(bikeshare.cache_file_path(str(city_file), 'cube'), None)
+    assert bikeshare.appended_range(str(city_file), cache) is None
+
+    cube = bikeshare.load_city_cube(str(city_file))
+    assert_same_cube(cube, fresh_cube(city_file))
+    assert 'Customerzz' in cube['user_type_names'].tolist()
+    assert (bikeshare.load_city_table(str(city_file))['User Type'] == 'Customerzz').sum() == 1
+
+
+def test_truncated_file_rebuilds_the_caches(city_file):
+    bikeshare.load_city_cube(str(city_file))
+    bikeshare.load_city_table(str(city_file))
+
+    write_city_file(city_file, city_rows(3000, 1)[:2000])
+
+    cache = bikeshare.read_cache_file(bikeshare.cache_file_path(str(city_file), 'cube'), None)
+    assert bikeshare.appended_range(str(city_file), cache) is None
+
+    assert_same_cube(bikeshare.load_city_cube(str(city_file)), fresh_cube(city_file))
+    assert len(bikeshare.load_city_table(str(city_file))) == 2000
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import bikeshare
+from test_ingest import city_rows, write_city_file
+
+
+def test_parallel_parsing_matches_serial_parsing(tmp_path):
+    file_path = str(tmp_path / 'city.csv')
+    write_city_file(file_path, city_rows(5000, 3))
+
+    pd.testing.assert_frame_equal(bikeshare.read_city_table_parallel(file_path, 3),
+                                  bikeshare.read_city_table(file_path))
+
+    cube = bikeshare.build_city_cube(file_path, 3)
+    expected = bikeshare.build_city_cube(file_path, 1)
+    assert cube.keys() == expected.keys()
+    for name in expected:
+        assert np.array_equal(cube[name], expected[name]), name
+
+
+def test_parse_workers_apply_to_cold_cube_builds(tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'city.csv')
+    write_city_file(file_path, city_rows(2000, 4))
+    monkeypatch.setattr(bikeshare, 'PARSE_WORKERS', 2)
+
+    build_city_cube = bikeshare.build_city_cube
+    workers = []
+
+    def record_workers(file_path, workers_used=1):
+        workers.append(workers_used)
+        return build_city_cube(file_path, workers_used)
+
+    monkeypatch.setattr(bikeshare, 'build_city_cube', record_workers)
+
+    cube = bikeshare.load_city_cube(file_path)
+    assert workers == [2]
+    assert int(cube['trip_counts'].sum()) == 2000
+    assert np.array_equal(cube['trip_counts'], bikeshare.build_cube(bikeshare.read_city_table(file_path))['trip_counts'])
@@ -0,0 +1,26 @@
+import time
+
+import bikeshare
+
+
+def test_nested_stages_are_not_counted_twice():
+    profiler = bikeshare.Profiler('detailed')
+    start = time.perf_counter()
+    with profiler.stage('outer'):
+        with profiler.stage('inner'):
+            time.sleep(0.05)
+            inner_memory = bytearray(8 << 20)
+            del inner_memory
+        outer_memory = bytearray(1 << 20)
+        del outer_memory
+    elapsed = time.perf_counter() - start
+    profiler.set_level('off')
+
+    inner, outer = profiler.records
+    assert inner['wall_seconds'] >= 0.05
+    assert outer['wall_seconds'] < 0.05
+    assert inner['wall_seconds'] + outer['wall_seconds'] <= elapsed
+
+    # The outer stage's peak includes the inner stage's, although that one restarted the peak.
+    assert inner['peak_traced_bytes'] >= 8 << 20
+    assert outer['peak_traced_bytes'] >= inner['peak_traced_bytes']
@@ -0,0 +1,29 @@
+import pandas as pd
+
+import bikeshare
+
+from test_ingest import city_rows, write_city_file
+
+
+def test_a_page_past_the_end_keeps_the_current_page(tmp_path, monkeypatch, capsys):
+    file_path = str(tmp_path / 'city.csv')
+    write_city_file(file_path, city_rows(12, 4))
+    monkeypatch.setitem(bikeshare.CITY_DATA, 'test city', file_path)
+    rows = pd.DataFrame(index=range(12))
+
+    raw_data_count = bikeshare.disp_raw_data('test city', rows, 0)
+    raw_data_count = bikeshare.disp_raw_data('test city', rows, raw_data_count)
+    assert raw_data_count == 2
+
+    # Page 99 does not exist, so the next and previous pages are unchanged.
+    raw_data_count = bikeshare.disp_raw_data('test city', rows, raw_data_count, page=98)
+    assert raw_data_count == 2
+    assert 'There is no more trip data to display.' in capsys.readouterr().out
+
+    raw_data_count = bikeshare.disp_raw_data('test city', rows, raw_data_count)
+    assert raw_data_count == 3
+    assert capsys.readouterr().out.count('\n') == 3
+
+    raw_data_count = bikeshare.disp_raw_data('test city', rows, raw_data_count,
+                                             page=max(raw_data_count - 2, 0))
+    assert raw_data_count == 2
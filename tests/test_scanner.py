@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+import bikeshare
+
+from test_ingest import HEADER, city_rows
+
+ROWS = city_rows(300, 8)
+
+
+def break_start_station(row):
+    # Quote the start station, with a line break inside the quotes.
+    fields = row.split(',')
+    fields[4] = '"' + fields[4].replace(' ', '\n') + '"'
+    return ','.join(fields)
+
+
+# The same trips, laid out in ways the block scanner must read as pandas does.
+LAYOUTS = {
+    'plain': HEADER + ''.join(ROWS),
+    'crlf line breaks': (HEADER + ''.join(ROWS)).replace('\n', '\r\n'),
+    'blank lines': HEADER + '\n' + ''.join(row + '\n' * (index % 3 == 0) for index, row in enumerate(ROWS)),
+    'missing final line break': HEADER + ''.join(ROWS)[:-1],
+    'quoted commas': HEADER + ''.join(row.replace('Station 1,', '"Station 1, Main St",', 1) for row in ROWS),
+    'escaped quotes': HEADER + ''.join(row.replace('Station 2,', '"Station ""2""",', 1) for row in ROWS),
+    'multi-line values': HEADER + ''.join(map(break_start_station, ROWS)),
+    'multi-line values with crlf': (HEADER + ''.join(map(break_start_station, ROWS))).replace('\n', '\r\n'),
+}
+
+
+def text_as_objects(table):
+    # The scanner keeps the text columns as categories, pandas as strings; the values must match.
+    return table.astype({name: object for name in bikeshare.STRING_COLUMNS if name in table})
+
+
+@pytest.mark.parametrize('block_size', [bikeshare.SCAN_BLOCK_SIZE, 1000])
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_scanner_reads_files_as_pandas_does(tmp_path, monkeypatch, layout, block_size):
+    file_path = tmp_path / 'city.csv'
+    file_path.write_bytes(LAYOUTS[layout].encode())
+    # Small blocks end inside rows with quoted or multi-line values.
+    monkeypatch.setattr(bikeshare, 'SCAN_BLOCK_SIZE', block_size)
+
+    expected = bikeshare.prepare_table(pd.read_csv(file_path, **bikeshare.CSV_OPTIONS))
+    table = bikeshare.read_city_table(str(file_path))
+
+    pd.testing.assert_frame_equal(text_as_objects(table), text_as_objects(expected))
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_byte_ranges_hold_whole_rows(tmp_path, layout):
+    file_path = tmp_path / 'city.csv'
+    file_path.write_bytes(LAYOUTS[layout].encode())
+
+    expected = bikeshare.read_city_table(str(file_path))
+    _, byte_ranges = bikeshare.split_byte_ranges(str(file_path), 7)
+    assert len(byte_ranges) == 7
+    table = bikeshare.concat_tables([bikeshare.read_byte_range(str(file_path), start, end)
+                                     for start, end in byte_ranges])
+
+    pd.testing.assert_frame_equal(text_as_objects(table).reset_index(drop=True),
+                                  text_as_objects(expected).reset_index(drop=True))
@@ -0,0 +1,39 @@
+import asyncio
+
+import bikeshare
+
+from test_ingest import city_rows, write_city_file
+
+
+def test_reloads_run_once_off_the_loop_and_serve_the_old_cube_meanwhile(tmp_path, monkeypatch):
+    bikeshare.result_cache.clear()
+    file_path = str(tmp_path / 'city.csv')
+    rows = city_rows(2000, 5)
+    write_city_file(file_path, rows)
+    monkeypatch.setattr(bikeshare, 'CITY_DATA', {'TEST CITY': file_path})
+    server = bikeshare.QueryServer()
+
+    load_cube = server.load_cube
+    loads = []
+
+    def record_load(city):
+        loads.append(city)
+        return load_cube(city)
+
+    monkeypatch.setattr(server, 'load_cube', record_load)
+    write_city_file(file_path, rows + city_rows(100, 6))
+
+    async def queries():
+        parameters = {'city': 'test_city'}
+        stale = await server.query('/stats', parameters)
+        waiting = [server.query('/timeseries', parameters) for _ in range(3)]
+        series = await asyncio.gather(*waiting)
+        fresh = await server.query('/stats', parameters)
+        return stale, series, fresh
+
+    (_, stale), series, (_, fresh) = asyncio.run(queries())
+    assert loads == ['TEST CITY']
+    assert stale['trip_count'] == 2000
+    assert fresh['trip_count'] == 2100
+    assert all(sum(map(sum, body['heatmap'])) == 2100 for _, body in series)
+    assert server.reloads == {}
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import bikeshare
+
+from test_ingest import city_rows, write_city_file
+
+
+@pytest.mark.parametrize('month_filter, day_filter', [('All', 'All'), ('March', 'All'), ('All', 'Sunday')])
+def test_user_type_breakdown_matches_the_trips(tmp_path, monkeypatch, month_filter, day_filter):
+    bikeshare.result_cache.clear()
+    file_path = str(tmp_path / 'city.csv')
+    write_city_file(file_path, city_rows(4000, 7))
+    monkeypatch.setitem(bikeshare.CITY_DATA, 'TEST CITY', file_path)
+
+    series = bikeshare.time_series('TEST CITY', month_filter, day_filter)
+    trips = bikeshare.load_data('TEST CITY', month_filter, day_filter)
+    user_types = trips['User Type'].astype(str).to_numpy()
+
+    assert sorted(series['user_types']) == sorted(set(user_types))
+    for user_type, user_type_series in series['user_types'].items():
+        start_times = trips['Start Time'][user_types == user_type]
+        heatmap = np.zeros((7, 24), dtype='int64')
+        np.add.at(heatmap, (start_times.dt.dayofweek, start_times.dt.hour), 1)
+        daily_trips = start_times.dt.strftime('%Y-%m-%d').value_counts().sort_index()
+
+        assert user_type_series['heatmap'] == heatmap.tolist()
+        assert user_type_series['daily_trips'] == list(zip(daily_trips.index, daily_trips.tolist()))
+
+    assert np.sum([entry['heatmap'] for entry in series['user_types'].values()], axis=0).tolist() == series['heatmap']
+
+    # The single pass counts the same trips exactly.
+    streamed = bikeshare.time_series('TEST CITY', month_filter, day_filter, approximate=True)
+    assert streamed['user_types'] == series['user_types']
+    assert streamed['heatmap'] == series['heatmap']
+    assert streamed['daily_trips'] == series['daily_trips']
@@ -0,0 +1,78 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bikeshare
+
+
+def strptime_fields(values):
+    """
+    Decode timestamps one by one with datetime.strptime, as the reference.
+
+    Args:
+    values (list): The timestamps as strings.
+
+    Returns:
+    dict: The fields decode_timestamps returns, as lists.
+    """
+    times = [datetime.strptime(value, bikeshare.TIME_FORMAT) for value in values]
+    return {'time': [np.datetime64(time, 's') for time in times],
+            'month': [time.month for time in times],
+            'day_of_week': [time.weekday() for time in times],
+            'hour': [time.hour for time in times]}
+
+
+def assert_matches_strptime(values):
+    decoded = bikeshare.decode_timestamps(pd.Series(values))
+    expected = strptime_fields(values)
+
+    assert decoded['time'].astype('datetime64[s]').tolist() == [time.item() for time in expected['time']]
+    for name in ['month', 'day_of_week', 'hour']:
+        assert decoded[name].tolist() == expected[name]
+
+
+def test_random_timestamps_match_strptime():
+    generator = random.Random(0)
+    start = datetime(2016, 12, 25)
+    values = [(start + timedelta(seconds=generator.randrange(200 * 86400))).strftime(bikeshare.TIME_FORMAT)
+              for _ in range(5000)]
+
+    assert_matches_strptime(values)
+
+
+@pytest.mark.parametrize('value', ['2016-02-29 12:00:00', '2017-12-31 23:59:59', '2018-01-01 00:00:00',
+                                   '1999-03-01 07:08:09', '2000-02-29 00:00:01'])
+def test_calendar_edges_match_strptime(value):
+    assert_matches_strptime([value, '2017-06-15 08:30:00'])
+
+
+def test_layout_the_decoder_skips_matches_strptime():
+    # Not zero padded, so parsed by pandas rather than at fixed offsets.
+    assert_matches_strptime(['2017-6-5 8:03:04', '2017-06-15 08:30:00'])
+
+
+@pytest.mark.parametrize('value', ['2017-01-01 25:00:00', '2017-01-01 24:00:00', '2017-01-01 00:61:00',
+                                   '2017-01-01 00:00:60', '2017-13-25 00:00:00', '2017-00-10 00:00:00',
+                                   '2017-01-00 00:00:00', '2017-01-32 00:00:00', '2017-02-30 00:00:00',
+                                   '2017-02-29 00:00:00', '0000-01-01 00:00:00', '2017-01-01T00:00:00',
+                                   '2017-01-01 00:00:0x', '2017-1-1 0:0:60'])
+def test_invalid_timestamps_are_rejected_like_strptime(value):
+    with pytest.raises(ValueError):
+        datetime.strptime(value, bikeshare.TIME_FORMAT)
+
+    with pytest.raises(ValueError):
+        bikeshare.decode_timestamps(pd.Series(['2017-06-15 08:30:00', value]))
+
+
+@pytest.mark.parametrize('value', ['2017-01-01 25:00:00', '2017-13-25 00:00:00', '2017-02-30 00:00:00'])
+def test_invalid_timestamps_are_rejected_when_scanning_a_file(tmp_path, value):
+    file_path = tmp_path / 'city.csv'
+    file_path.write_text(',Start Time,End Time,Trip Duration,Start Station,End Station,User Type\n'
+                         '1,2017-06-15 08:30:00,2017-06-15 08:40:00,600,A,B,Subscriber\n'
+                         f'2,{value},2017-06-15 08:40:00,600,A,B,Subscriber\n')
+
+    with pytest.raises(ValueError):
+        bikeshare.read_city_table(str(file_path))